@@ -1,20 +1,51 @@
 import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
 import pandas as pd
 import os
-import json
+import hmac
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, send_file
+from flask import (
+    Flask,
+    Response,
+    before_render_template,
+    g,
+    jsonify,
+    render_template,
+    request,
+    send_file,
+    template_rendered,
+)
 from datetime import date
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
-from collections import OrderedDict
-import operator
+import cube
+import export
+import kobo
+import labels
+import metrics
+import pages
+import rotations
+import shared
+import singleflight
+import snapshot
+from normalize import normalize_submissions, replace_submissions
+from patients import get_patient, get_patients
+from search import SEARCH_LIMIT, search_patients
+from summary import SummaryState, aggregate_summary
+from timeline import build_timelines
 
 app = Flask(__name__)
 load_dotenv()  # take environment variables from .env
 
+# load data saved on disk before any network call; with shared data, only
+# the worker that syncs with KoBo loads submissions
+if not shared.enabled():
+    kobo.load_snapshot()
+rotations.load_snapshot()
+labels.get_registry()
+
 referral_states = [
     "Referral is not needed",
     "Referral is needed, not urgent",
@@ -22,8 +53,56 @@ referral_states = [
     "Referral is needed, medevac",
 ]
 
-
-def process_data(df_form, bracelet_number=None, first=False):
+# number of patients in the form to update several referrals
+BULK_UPDATE_ROWS = 20
+
+# KoBo fields to update for each referral state
+referral_updates = {
+    "Referral is not needed": {"referral": "no"},
+    "Referral is needed, not urgent": {
+        "referral": "yes",
+        "referral_urgency": "not_urgent",
+    },
+    "Referral is needed, urgent": {"referral": "yes", "referral_urgency": "urgent"},
+    "Referral is needed, medevac": {"referral": "yes", "referral_urgency": "medevac"},
+}
+
+# seconds between background refreshes of the data
+REFRESH_INTERVAL = float(os.getenv("REFRESH_INTERVAL", 60))
+
+# seconds to wait for KoBo and Google Sheets before using their last data
+KOBO_TIMEOUT = float(os.getenv("KOBO_TIMEOUT", 60))
+SHEETS_TIMEOUT = float(os.getenv("SHEETS_TIMEOUT", 30))
+
+# requests slower than this many seconds are logged with the time of each
+# stage; not logged if unset
+SLOW_REQUEST_SECONDS = os.getenv("SLOW_REQUEST_SECONDS")
+SLOW_REQUEST_SECONDS = None if not SLOW_REQUEST_SECONDS else float(SLOW_REQUEST_SECONDS)
+
+# seconds between checks of the summary of morbidities against a full recount
+SUMMARY_CHECK_INTERVAL = float(os.getenv("SUMMARY_CHECK_INTERVAL", 3600))
+
+# data of the latest version of submissions and rotations
+_data_cache = {}
+_refresh_lock = threading.Lock()
+# concurrent refreshes share one fetch from KoBo and Google Sheets
+_refresh_flights = singleflight.Group()
+_fetch_executor = ThreadPoolExecutor(max_workers=2)
+
+# normalized submissions of all rotations, with the version of the local
+# store and the rotation table they are up to date with
+_all_data = (None, None, None)
+
+# summary of morbidities of the latest data
+_summary_state = None
+_summary = (None, None)
+_summary_checked_at = 0.0
+_refresh_requested = threading.Event()
+_refresher = None
+_refresher_lock = threading.Lock()
+
+
+def process_data(df_form, bracelet_number=None, first=False, update_failed=False):
     """
     process data to show patient information page
     """
@@ -40,310 +119,398 @@ def process_data(df_form, bracelet_number=None, first=False):
             "data.html", not_found=True, bracelet_number=bracelet_number
         )
 
-    df = df_form[df_form["bracelet_number"] == bracelet_number]
-    df = df.reset_index(drop=True)
+    with metrics.span("patient_lookup") as span:
+        df = get_patient(df_form, bracelet_number)
+        span["rows"] = len(df)
 
-    # error page, in case no data is not found
+    # error page, in case no data is not found, with patients whose bracelet
+    # number, name or diagnosis match, or whose bracelet number differs in
+    # the last digit
     if df.empty:
+        suggestions = []
+        if bracelet_number:
+            suggestions = search_patients(df_form, bracelet_number) or search_patients(
+                df_form, bracelet_number[:-1]
+            )
         return render_template(
-            "data.html", not_found=True, bracelet_number=bracelet_number
+            "data.html",
+            not_found=True,
+            bracelet_number=bracelet_number,
+            suggestions=suggestions,
         )
 
-    try:
-        df["start"] = pd.to_datetime(df["start"])
-    except ValueError:
-        df["start"] = pd.to_datetime(df["start"], utc=True)
-
-    # patient info
-    info = {}
-    for x in ["name", "gender", "age"]:
-        if x in df.columns:
-            info_data = df[x].dropna().unique()
-            if len(info_data) > 0:
-                info[x] = info_data[-1]
-            else:
-                info[x] = "unknown"
-    if "age" in info.keys():
-        info["age"] = map_age(info["age"])
-
-    # consultations and referral status
-    consultations = []
-    referral = {}
-    for ix, row in df.iterrows():
-        consultation = {}
-        consultation["Date"] = row["start"].date()
-        consultation["Diagnosis"] = ""
-        for level in ["primary", "secondary", "tertiary"]:
-            case_key = level + "_case"
-            # case_label = level.capitalize()+' Diagnosis'
-            if case_key in row.keys():
-                if not pd.isna(row[case_key]):
-                    case = row[case_key]
-                    case = case_map(case)
-                    if case == "Other":
-                        case = row[level + "_case_other"]
-                    if consultation["Diagnosis"] == "":
-                        consultation["Diagnosis"] = case
-                    else:
-                        consultation["Diagnosis"] = (
-                            consultation["Diagnosis"] + ", " + case
-                        )
-        if "history" in row.keys():
-            history = row["history"]
-            if pd.isna(history):
-                history = "none"
-            consultation["History"] = history
-        if "vital_signs" in row.keys():
-            vital_signs = row["vital_signs"]
-            if pd.isna(vital_signs):
-                vital_signs = "none"
-            consultation["Vital signs"] = vital_signs
-        treatment = row["treatment"]
-        if pd.isna(treatment):
-            treatment = "nothing"
-        consultation["Treatment"] = treatment
-        if "info" in row.keys():
-            info_text = row["info"]
-            if not pd.isna(info_text):
-                consultation["Other information"] = info_text
-        if ix == len(df) - 1:
-            if row["referral"] == "yes":
-                if not pd.isna(row["referral_urgency"]):
-                    urgency = row["referral_urgency"].replace("_", " ")
-                    if urgency != "not needed":
-                        referral["Referral is needed:"] = urgency
-                    else:
-                        referral["Referral is not needed"] = ""
-                else:
-                    referral["Referral is needed"] = ""
-            else:
-                referral["Referral is not needed"] = ""
-        consultations.append(consultation)
-
+    with metrics.span("timeline_build") as span:
+        timeline = next(iter(build_timelines(df).values()))
+        span["rows"] = len(df)
     return render_template(
         "data.html",
-        info=info,
-        consultations=consultations,
-        referral=referral,
+        info=timeline["info"],
+        consultations=timeline["consultations"],
+        referral=timeline["referral"],
         referral_states=referral_states,
+        update_failed=update_failed,
     )
 
 
 def get_data():
     """
-    get data from KoBo
-    """
-    headers = {"Authorization": f'Token {os.getenv("TOKEN")}'}
-    session = requests.Session()
-    retry = Retry(connect=10, backoff_factor=0.5)
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount("http://", adapter)
-    session.mount("https://", adapter)
-    data_request = session.get(
-        f'https://kobo.ifrc.org/api/v2/assets/{os.getenv("ASSET")}/data.json',
-        headers=headers,
-    )
-    data = data_request.json()
-
-    # get rotation info
-    SCOPES = ["https://www.googleapis.com/auth/spreadsheets.readonly"]
-    SAMPLE_SPREADSHEET_ID = os.getenv("GOOGLESHEETID")
-    SAMPLE_RANGE_NAME = "Rotations!A:C"
-    sa_file = json.loads(os.getenv("GOOGLESERVICEACCUNT"))
-    creds = service_account.Credentials.from_service_account_info(
-        sa_file, scopes=SCOPES
-    )
-    service = build("sheets", "v4", credentials=creds)
-    # Call the Sheets API
-    sheet = service.spreadsheets()
-    result = (
-        sheet.values()
-        .get(spreadsheetId=SAMPLE_SPREADSHEET_ID, range=SAMPLE_RANGE_NAME)
-        .execute()
-    )
-    values = result.get("values", [])
-    df = pd.DataFrame.from_records(values[1:], columns=values[0])
-    df["Start date"] = pd.to_datetime(df["Start date"], dayfirst=True)
-    df["End date"] = pd.to_datetime(df["End date"], dayfirst=True)
-    df["Rotation No"] = df["Rotation No"].astype(float).round(0).astype(int)
-    rotation_no = max(df["Rotation No"])
-    start_date_ = pd.to_datetime(date.today(), utc=True)
-    end_date_ = pd.to_datetime(date.today(), utc=True)
-
-    if "results" in data.keys():
-        df_form = pd.DataFrame(data["results"])
-        if df_form.empty:
-            return df_form, rotation_no
+    get the latest data, which is refreshed in the background
+    """
+    start_refresher()
+    if not _lead():
+        return _shared_data()
+    with metrics.span("get_data") as span:
+        span["cache"] = "hit" if _data_cache else "miss"
+        if not _data_cache:
+            if kobo.get_version() == 0:
+                return refresh_data()
+            # serve the snapshot loaded from disk and sync in the background
+            request_refresh()
+            return refresh_data(sync=False)
+        return next(iter(_data_cache.values()))
+
+
+def refresh_data(sync=True, join=True):
+    """
+    get data from KoBo, syncing only what changed since the last refresh;
+    with sync=False, only the local store and rotation table are used.
+    Concurrent callers share the refresh in progress, unless join=False
+    (after a change to the local store that it may not include)
+    """
+    if not _lead():
+        return _shared_data(wait=not join)
+    if not join:
+        _refresh_flights.forget(sync)
+    return _refresh_flights.do(sync, lambda: _locked_refresh_data(sync))
+
+
+def _locked_refresh_data(sync):
+    with _refresh_lock:
+        return _refresh_data(sync)
+
+
+def _lead():
+    """
+    whether this worker syncs with KoBo: always, unless data is shared by
+    several workers and another one does
+    """
+    if shared.enabled() and not shared.lead():
+        return False
+    kobo.load_snapshot()
+    return True
+
 
+def _shared_data(wait=False):
+    """
+    get the data published by the worker that syncs with KoBo; with
+    wait=True, wait until it includes the changes this worker handed over
+    """
+    global _data_cache, _summary
+    pending = kobo.get_pending()[0] if wait else 0
+    published = shared.wait_for(pending, KOBO_TIMEOUT)
+    if published is None:
+        df_form = pd.DataFrame()
+        df_form.attrs["version"] = ("shared", 0)
+        return df_form, None
+    version = ("shared", published["generation"])
+    with metrics.span("shared_load") as span:
+        data = _data_cache.get(version)
+        span["cache"] = "miss" if data is None else "hit"
+        if data is None:
+            with _refresh_lock:
+                data = _data_cache.get(version)
+                if data is None:
+                    df_form, rotation_no, summary = shared.load(published)
+                    data = (df_form, rotation_no)
+                    _summary = (version, summary)
+                    _data_cache = {version: data}
+        span["rows"] = len(data[0])
+    return data
+
+
+def _refresh_data(sync):
+    """
+    sync submissions and rotations and rebuild data if they changed
+    """
+    global _data_cache
+
+    # get submissions and rotation info at the same time
+    started_at = time.time()
+    rotations_future = _fetch_executor.submit(rotations.get_rotations, sync)
+    if sync:
+        kobo_future = _fetch_executor.submit(kobo.sync_submissions)
+        with metrics.span("kobo_sync"):
+            try:
+                kobo_future.result(timeout=KOBO_TIMEOUT)
+            except (requests.RequestException, ValueError, TimeoutError) as e:
+                app.logger.warning(
+                    f"could not sync KoBo submissions, using local store: {e!r}"
+                )
+    with metrics.span("rotations_get"):
+        try:
+            df = rotations_future.result(
+                timeout=max(0, SHEETS_TIMEOUT - (time.time() - started_at))
+            )
+        except Exception as e:
+            df = rotations.get_last_rotations()
+            app.logger.warning(f"could not get rotations, using last table: {e!r}")
+
+    if df is None:
+        # no rotation table at all: show all submissions
+        rotation_no = None
+        start_date_ = pd.Timestamp.min.tz_localize("UTC")
+        end_date_ = pd.Timestamp.max.tz_localize("UTC")
+    else:
+        rotation_no = max(df["Rotation No"])
+        start_date_ = pd.to_datetime(date.today(), utc=True)
+        end_date_ = pd.to_datetime(date.today(), utc=True)
         for ix, row in df.iterrows():
             if row["Start date"] <= pd.to_datetime(date.today()) <= row["End date"]:
                 rotation_no = row["Rotation No"]
                 start_date_ = pd.to_datetime(row["Start date"], utc=True)
                 end_date_ = pd.to_datetime(row["End date"], utc=True)
 
-        df_form["start"] = pd.to_datetime(df_form["start"], utc=True)
-        df_form = df_form[
-            (df_form["start"] >= start_date_) & (df_form["start"] <= end_date_)
-        ]
-        if not df_form.empty:
-            df_form["rotation_no"] = rotation_no
-        else:
-            df_form = pd.DataFrame()
+    # build data only if submissions or rotations changed
+    table = None
+    if df is not None:
+        table = tuple(
+            df[["Rotation No", "Start date", "End date"]].itertuples(
+                index=False, name=None
+            )
+        )
+    version = (kobo.get_version(), rotation_no, start_date_, end_date_, table)
+    if version in _data_cache.keys():
+        metrics.record("data_build", 0, {"cache": "hit"})
+        if shared.enabled():
+            shared.update_synced_at(kobo.get_synced_at())
+        return _data_cache[version]
+
+    pending = kobo.get_pending()[1]
+    df_all = update_all_data(version[0], df, table)
+    if df_all is not None:
+        if df is not None:
+            # summaries of all rotations, for past rotations and trends
+            with metrics.span("cube_update"):
+                cube.update_cube(df_all, df["Rotation No"], version[0])
+        with metrics.span("rotation_filter") as span:
+            start = df_all["start"]
+            df_form = df_all[(start >= start_date_) & (start <= end_date_)].copy()
+            if not df_form.empty:
+                df_form["rotation_no"] = rotation_no
+            else:
+                df_form = pd.DataFrame()
+            span["rows"] = len(df_form)
     else:
         df_form = pd.DataFrame()
+    df_form.attrs["version"] = version
+    # tag of this data for the pages rendered from it, unique across
+    # restarts and, through the published data, the same in all workers
+    df_form.attrs["tag"] = uuid.uuid4().hex
+    with metrics.span("summary_update") as span:
+        span["rows"] = len(df_form)
+        update_summary(df_form)
+    _data_cache = {version: (df_form, rotation_no)}
+    if shared.enabled():
+        with metrics.span("shared_publish") as span:
+            span["rows"] = len(df_form)
+            shared.publish(
+                df_form, rotation_no, _summary[1], kobo.get_synced_at(), pending
+            )
     return df_form, rotation_no
 
 
-def process_summary(df_form):
+def update_all_data(kobo_version, df, table):
     """
-    process data to show summary of morbidities
+    update the normalized submissions of all rotations to a version of the
+    local store, with the rotation of each in rotation_no if the rotation
+    table df is known; only the submissions that changed since the last
+    update are normalized again. None if there are no submissions
     """
-    morbidities_all, referral_all = {}, {}
-    consultations = len(df_form)
-    if "bracelet_number" not in df_form.columns:
-        consultations = 0
-        patients = 0
-        morbidities_all_ordered = {}
-        referral_all = {}
+    global _all_data
+    version, rotation_table, df_all = _all_data
+    changes = None
+    if df_all is not None and "_id" in df_all.columns:
+        changes = kobo.get_changes(version)
+    with metrics.span("data_build") as span:
+        if changes is None:
+            span["cache"] = "miss"
+            submissions = kobo.get_submissions()
+            df_all = pd.DataFrame(submissions)
+            labels.report_drift(df_all)
+            df_all = normalize_submissions(df_all)
+        else:
+            span["cache"] = "partial"
+            submissions = kobo.get_submissions(changes)
+            df_changed = pd.DataFrame(submissions)
+            labels.report_drift(df_changed)
+            df_changed = normalize_submissions(df_changed)
+            same_rotations = df is not None and table == rotation_table
+            if not df_changed.empty and same_rotations and "rotation_no" in df_all:
+                df_changed["rotation_no"] = rotations.assign_rotations(
+                    df_changed["start"], df
+                )
+            df_all = replace_submissions(df_all, df_changed, changes)
+        span["rows"] = len(submissions)
+    if df is not None and "start" in df_all.columns:
+        if changes is None or table != rotation_table or "rotation_no" not in df_all:
+            # a new frame, as the cube keeps the rotations it was given
+            df_all = df_all.assign(
+                rotation_no=rotations.assign_rotations(df_all["start"], df)
+            )
+    _all_data = (kobo_version, table, df_all)
+    return None if df_all.empty else df_all
+
+
+def get_all_data():
+    """
+    get the normalized submissions of all rotations, with the rotation of
+    each; other workers than the one syncing with KoBo read them from the
+    snapshot
+    """
+    if _lead():
+        get_data()
+        df_all = _all_data[2]
     else:
-        patients = df_form["bracelet_number"].nunique()
-        labels = ["male", "female", "u5", "total"]
-
-        for bracelet in df_form["bracelet_number"].unique():
-            df = df_form[df_form["bracelet_number"] == bracelet]
-
-            morbidities = {}
-            referrals = {}
-            for ix, row in df.iterrows():
-                for level in ["primary", "secondary", "tertiary"]:
-                    case_key = level + "_case"
-                    if case_key in row.keys():
-                        if not pd.isna(row[case_key]):
-                            case = row[case_key]
-                            case = case_map(case)
-                            label = ""
-                            if case == "Other":
-                                case = row[level + "_case_other"]
-                            if row["age"] == "u1" or row["age"] == "1_4":
-                                label = "u5"
-                            else:
-                                if row["gender"] == "male":
-                                    label = "male"
-                                elif row["gender"] == "female":
-                                    label = "female"
-                            if label != "":
-                                morbidities[case] = {
-                                    label: 1,
-                                    "total": 1,
-                                    "bracelet": bracelet,
-                                }
-                            else:
-                                morbidities[case] = {"total": 1, "bracelet": bracelet}
-                if row["referral"] == "yes":
-                    referrals["Referrals needed"] = 1
-                    if not pd.isna(row["referral_urgency"]):
-                        urgency = row["referral_urgency"].replace("_", " ").capitalize()
-                        referrals[urgency] = 1
-
-            for key, morb_dict in morbidities.items():
-                if key in morbidities_all.keys():
-                    morb_dict_all = morbidities_all[key]
-                    for label in labels:
-                        if label in morb_dict.keys():
-                            morb_dict_all[label] = morb_dict_all[label] + 1
-                    morb_dict_all["bracelet"] = (
-                        morb_dict_all["bracelet"] + ", " + morb_dict["bracelet"]
-                    )
-                    morbidities_all[key] = morb_dict_all
-                else:
-                    for label in labels:
-                        if label not in morb_dict.keys():
-                            morb_dict[label] = 0
-                    morbidities_all[key] = morb_dict
-
-            for key in referrals.keys():
-                if key in referral_all.keys():
-                    referral_all[key] = referral_all[key] + 1
-                else:
-                    referral_all[key] = 1
-
-        # add data of patients without bracelet number
-        df_no_bracelet = (
-            df_form[pd.isna(df_form["bracelet_number"])]
-            .groupby(["age", "gender"])
-            .last()
-            .reset_index()
-        )
-        patients = patients + len(df_no_bracelet)
-
-        for ix, row in df_no_bracelet.iterrows():
-            morbidities = {}
-            referrals = {}
-            for level in ["primary", "secondary", "tertiary"]:
-                case_key = level + "_case"
-                if case_key in row.keys():
-                    if not pd.isna(row[case_key]):
-                        case = row[case_key]
-                        case = case_map(case)
-                        label = "other"
-                        if row["age"] == "u1" or row["age"] == "1_4":
-                            label = "u5"
-                        else:
-                            if row["gender"] == "male":
-                                label = "male"
-                            elif row["gender"] == "female":
-                                label = "female"
-                        morbidities[case] = {label: 1, "total": 1}
-            if row["referral"] == "yes":
-                referrals["Referrals needed"] = 1
-                if not pd.isna(row["referral_urgency"]):
-                    urgency = row["referral_urgency"].replace("_", " ").capitalize()
-                    referrals[urgency] = 1
-
-            for key, morb_dict in morbidities.items():
-                if key in morbidities_all.keys():
-                    morb_dict_all = morbidities_all[key]
-                    for label in labels:
-                        if label in morb_dict.keys():
-                            morb_dict_all[label] = morb_dict_all[label] + 1
-                    if "bracelet" in morb_dict.keys():
-                        morb_dict_all["bracelet"] = (
-                            morb_dict_all["bracelet"] + ", " + morb_dict["bracelet"]
-                        )
-                    else:
-                        morb_dict_all["bracelet"] = (
-                            morb_dict_all["bracelet"] + ", " + "NaN"
-                        )
-                    morbidities_all[key] = morb_dict_all
-                else:
-                    for label in labels:
-                        if label not in morb_dict.keys():
-                            morb_dict[label] = 0
-                    morbidities_all[key] = morb_dict
-
-            for key in referrals.keys():
-                if key in referral_all.keys():
-                    referral_all[key] = referral_all[key] + 1
-                else:
-                    referral_all[key] = 1
-
-        # sort morbidities by total
-        morbidities_all_ordered = OrderedDict()
-        totals = {}
-        for key, value in morbidities_all.items():
-            totals[key] = value["total"]
-        sorted_totals = dict(
-            sorted(totals.items(), key=operator.itemgetter(1), reverse=True)
-        )
-        for key in sorted_totals.keys():
-            morbidities_all_ordered[key] = morbidities_all[key]
+        df_all = normalize_submissions(pd.DataFrame(snapshot.load_submissions()[0]))
+        df = rotations.get_last_rotations()
+        if df is not None and "start" in df_all.columns:
+            df_all["rotation_no"] = rotations.assign_rotations(df_all["start"], df)
+    return pd.DataFrame() if df_all is None else df_all
+
+
+def update_summary(df_form):
+    """
+    update the summary of morbidities with the submissions that changed
+    since the last version of the data; rebuild it if unknown, or if it no
+    longer matches a full recount (checked every SUMMARY_CHECK_INTERVAL)
+    """
+    global _summary_state, _summary, _summary_checked_at
+    version = df_form.attrs["version"]
+    state = _summary_state
+    changes = None
+    if state is not None and state.version[1:] == version[1:]:
+        changes = kobo.get_changes(state.version[0])
+    if changes is None or "_id" not in df_form.columns:
+        state = SummaryState.from_data(df_form)
+        _summary_checked_at = time.time()
+    else:
+        df_changed = df_form[df_form["_id"].isin(changes)]
+        state.remove(changes - set(df_changed["_id"]))
+        state.upsert(df_changed)
+        state.version = version
+    result = state.summary()
+
+    if time.time() - _summary_checked_at > SUMMARY_CHECK_INTERVAL:
+        _summary_checked_at = time.time()
+        if result != aggregate_summary(df_form):
+            app.logger.warning("summary of morbidities was out of date, rebuilding")
+            state = SummaryState.from_data(df_form)
+            result = state.summary()
+    _summary_state = state
+    _summary = (version, result)
+
+
+def start_refresher():
+    """
+    start the thread that refreshes data in the background
+    """
+    global _refresher
+    if _refresher is None:
+        with _refresher_lock:
+            if _refresher is None:
+                _refresher = threading.Thread(target=_refresh_loop, daemon=True)
+                _refresher.start()
+
+
+def request_refresh():
+    """
+    refresh data in the background as soon as possible
+    """
+    _refresh_requested.set()
+
 
+def _refresh_loop():
+    """
+    refresh data every REFRESH_INTERVAL seconds, or earlier when requested;
+    with shared data, only the worker that syncs with KoBo refreshes, and it
+    also applies the changes handed over by other workers
+    """
+    due = time.time() + REFRESH_INTERVAL
+    while True:
+        timeout = due - time.time()
+        if shared.enabled():
+            timeout = min(timeout, shared.POLL_INTERVAL)
+        if _refresh_requested.wait(max(0, timeout)):
+            _refresh_requested.clear()
+            due = 0
+        if not _lead():
+            # another worker refreshes; wait for the next poll
+            due = time.time() + REFRESH_INTERVAL
+            continue
+        try:
+            if time.time() >= due:
+                due = time.time() + REFRESH_INTERVAL
+                refresh_data()
+                app.logger.debug(
+                    "refreshes: %(calls)d calls, %(flights)d fetches, "
+                    "%(coalesced)d coalesced",
+                    _refresh_flights.stats(),
+                )
+            elif shared.enabled() and kobo.load_pending():
+                refresh_data(sync=False, join=False)
+        except Exception:
+            app.logger.exception("could not refresh data")
+
+
+@app.context_processor
+def inject_data_age():
+    """
+    show how old the data is on every page
+    """
+    synced_at = kobo.get_synced_at()
+    if synced_at is None and shared.enabled():
+        published = shared.get_published()
+        synced_at = None if published is None else published["synced_at"]
+    if synced_at is None:
+        return {}
+    return {"data_age": int((time.time() - synced_at) / 60)}
+
+
+def cached_page(df_form, view, render):
+    """
+    respond with a view of df_form, rendered once per version of the data
+    and age shown
+    """
+    view = view + (inject_data_age().get("data_age"),)
+    return pages.respond(df_form.attrs.get("tag"), view, render)
+
+
+def process_summary(df_form, rotation_no=None, rotation=None):
+    """
+    process data to show summary of morbidities, of the current rotation or
+    of a past one from the cube
+    """
+    with metrics.span("summary_aggregate") as span:
+        if rotation is not None and rotation != rotation_no:
+            span["cache"] = "cube"
+            result = cube.rotation_summary(rotation) or (0, 0, {}, {})
+        elif _summary[0] == df_form.attrs.get("version"):
+            span["cache"] = "hit"
+            result = _summary[1]
+        else:
+            span["cache"] = "miss"
+            span["rows"] = len(df_form)
+            result = aggregate_summary(df_form)
+    consultations, patients, morbidities, referrals = result
     return render_template(
         "summary.html",
         consultations=consultations,
         patients=patients,
-        morbidities=morbidities_all_ordered,
-        referrals=referral_all,
+        morbidities=morbidities,
+        referrals=referrals,
+        rotations=cube.rotation_nos(),
+        rotation=rotation_no if rotation is None else rotation,
+        current=rotation is None or rotation == rotation_no,
     )
 
 
@@ -354,122 +521,158 @@ def update_submission():
     """
     bracelet_number = request.form["bracelet"]
     df_form, rotation_no = get_data()
-    df = df_form[df_form["bracelet_number"] == bracelet_number].reset_index(drop=True)
+    df = get_patient(df_form, bracelet_number).reset_index(drop=True)
 
     if df.empty:
         return process_data(df_form, bracelet_number)
 
     submission_id = df.iloc[len(df) - 1]["_id"]
 
-    # update submission in kobo
-    url = f'https://kobo.ifrc.org/api/v2/assets/{os.getenv("ASSET")}/data/bulk/'
-    headers = {"Authorization": f'Token {os.getenv("TOKEN")}'}
-    params = {"format": "json"}
-
+    # update submission in kobo and in the local data
     referral_update = request.form["referral"]
-
-    if referral_update == "Referral is not needed":
-        payload = {"submission_ids": [str(submission_id)], "data": {"referral": "no"}}
-        requests.patch(
-            url=url,
-            data={"payload": json.dumps(payload)},
-            params=params,
-            headers=headers,
-        )
-    else:
-        payload = {"submission_ids": [str(submission_id)], "data": {"referral": "yes"}}
-        requests.patch(
-            url=url,
-            data={"payload": json.dumps(payload)},
-            params=params,
-            headers=headers,
+    try:
+        updated = kobo.update_submissions(
+            [submission_id], referral_updates[referral_update]
         )
-        referral_urgency_dict = {
-            "Referral is needed, not urgent": "not_urgent",
-            "Referral is needed, urgent": "urgent",
-            "Referral is needed, medevac": "medevac",
-        }
-        payload = {
-            "submission_ids": [str(submission_id)],
-            "data": {"referral_urgency": referral_urgency_dict[referral_update]},
-        }
-        requests.patch(
-            url=url,
-            data={"payload": json.dumps(payload)},
-            params=params,
-            headers=headers,
+    except requests.RequestException as e:
+        app.logger.error(f"could not update referral of {bracelet_number}: {e}")
+        return process_data(df_form, bracelet_number, update_failed=True)
+    if not updated:
+        app.logger.error(f"KoBo did not update referral of {bracelet_number}")
+        return process_data(df_form, bracelet_number, update_failed=True)
+
+    request_refresh()
+    df_form, rotation_no = refresh_data(sync=False, join=False)
+    return cached_page(
+        df_form,
+        ("data", bracelet_number),
+        lambda: process_data(df_form, bracelet_number),
+    )
+
+
+@app.route("/updatesubmissions", methods=["POST"])
+def update_submissions():
+    """
+    update referral status of several patients at once
+    """
+    updates = {}
+    # a pasted list of bracelet numbers, all with the same referral status
+    for bracelet_number in re.split(r"[\s,;]+", request.form.get("bracelets", "")):
+        if bracelet_number != "":
+            updates[bracelet_number] = request.form.get("bracelets_referral")
+    for bracelet_number, referral_update in zip(
+        request.form.getlist("bracelet"), request.form.getlist("referral")
+    ):
+        if bracelet_number.strip() != "":
+            updates[bracelet_number.strip()] = referral_update
+    if not updates:
+        return render_template(
+            "bulkupdate.html", rows=BULK_UPDATE_ROWS, referral_states=referral_states
         )
 
+    # find latest submission of each patient, grouped by fields to update
     df_form, rotation_no = get_data()
-    return process_data(df_form, bracelet_number)
+    results, groups = {}, {}
+    for bracelet_number, referral_update in updates.items():
+        results[bracelet_number] = {"referral": referral_update}
+        df = get_patient(df_form, bracelet_number)
+        if df.empty:
+            results[bracelet_number]["status"] = "patient not found"
+        elif referral_update not in referral_updates.keys():
+            results[bracelet_number]["status"] = "unknown referral status"
+        else:
+            group = groups.setdefault(referral_update, {})
+            group[bracelet_number] = df.iloc[len(df) - 1]["_id"]
+
+    # one request to KoBo per referral status
+    for referral_update, submissions in groups.items():
+        try:
+            updated = kobo.update_submissions(
+                list(submissions.values()), referral_updates[referral_update]
+            )
+        except requests.RequestException as e:
+            app.logger.error(f"could not update referral of {list(submissions)}: {e}")
+            updated = None
+        for bracelet_number, submission_id in submissions.items():
+            if updated is None:
+                status = "update failed"
+            elif int(submission_id) in updated:
+                status = "updated"
+            else:
+                status = "rejected by KoBo"
+            results[bracelet_number]["status"] = status
+
+    if groups:
+        request_refresh()
+        refresh_data(sync=False, join=False)
+    return render_template(
+        "bulkupdate.html",
+        rows=BULK_UPDATE_ROWS,
+        referral_states=referral_states,
+        results=results,
+    )
 
 
 @app.route("/downloaddata", methods=["POST"])
 def download_data():
+    """
+    download data of referrals as Excel, CSV or Parquet file
+    """
+    export_format = request.form.get("format", "xlsx")
+    if export_format not in export.writers.keys():
+        export_format = "xlsx"
+    try:
+        rotation = request.form.get("rotation") or None
+        rotation = None if rotation is None else int(rotation)
+        start_date = export.parse_date(request.form.get("start_date") or None)
+        end_date = export.parse_date(request.form.get("end_date") or None)
+    except ValueError as e:
+        return {"error": f"invalid filter: {e}"}, 400
+
+    # the current rotation, unless filters ask for submissions of any other
     df_form, rotation_no = get_data()
+    if (rotation is not None and rotation != rotation_no) or start_date or end_date:
+        df_form = get_all_data()
+    with metrics.span("export_filter") as span:
+        df_form = export.filter_data(
+            df_form, rotation=rotation, start_date=start_date, end_date=end_date
+        )
+        df_referrals = export.referral_data(df_form)
+        span["rows"] = len(df_referrals)
+    with metrics.span(f"export_{export_format}") as span:
+        buffer = export.writers[export_format](df_referrals)
+        span["bytes"] = buffer.getbuffer().nbytes
+    return send_file(
+        buffer,
+        mimetype=export.EXPORT_FORMATS[export_format],
+        as_attachment=True,
+        download_name=f"referral-data.{export_format}",
+    )
 
-    # keep only referrals
-    df_form = df_form[df_form["referral"] == "yes"]
-
-    # change age
-    df_form["age"] = df_form["age"].apply(map_age)
-
-    # merge diagnoses
-    df_form["diagnosis"] = df_form["primary_case"]
-    for ix, row in df_form.iterrows():
-        diagnosis = case_map(row["diagnosis"])
-        if "secondary_case" in df_form.columns:
-            if not pd.isna(row["secondary_case"]):
-                diagnosis = diagnosis + ", " + case_map(row["secondary_case"])
-        if "tertiary_case" in df_form.columns:
-            if not pd.isna(row["tertiary_case"]):
-                diagnosis = diagnosis + ", " + case_map(row["tertiary_case"])
-        df_form.at[ix, "diagnosis"] = diagnosis
-    df_form = df_form.drop(columns=["primary_case", "secondary_case", "tertiary_case"])
-
-    # keep only meaningful columns
-    columns_to_keep = [
-        "_submission_time",
-        "bracelet_number",
-        "name",
-        "gender",
-        "age",
-        "diagnosis",
-        "history",
-        "vital_signs",
-        "treatment",
-        "info",
-        "referral_urgency",
-    ]
-    columns_to_keep = [x for x in columns_to_keep if x in df_form.columns]
-    df_form = df_form[columns_to_keep]
 
-    # order by bracelet number
-    df_form["bracelet_number"] = df_form["bracelet_number"].astype(
-        float, errors="ignore"
-    )
-    df_form = df_form.sort_values(by="bracelet_number")
-
-    data_path = "referral-data.xlsx"
-    if os.path.exists(data_path):
-        os.remove(data_path)
-    writer = pd.ExcelWriter(data_path, engine="xlsxwriter")
-    df_form.to_excel(writer, sheet_name="DATA", index=False)  # send df to writer
-    worksheet = writer.sheets["DATA"]  # pull worksheet object
-    for idx, col in enumerate(df_form.columns):  # loop through all columns
-        series = df_form[col]
-        max_len = (
-            max(
-                (
-                    series.astype(str).map(len).max(),  # len of largest item
-                    len(str(series.name)),  # len of column name/header
-                )
-            )
-            + 1
-        )
-        worksheet.set_column(idx, idx, max_len)  # set column width
-    writer._save()
-    return send_file(data_path, as_attachment=True)
+@app.route("/kobo-hook", methods=["POST"])
+def kobo_hook():
+    """
+    receive a new or edited submission from a KoBo REST service
+    """
+    secret = os.getenv("KOBO_HOOK_SECRET")
+    received = request.headers.get("X-Kobo-Hook-Secret")
+    if received is None and request.authorization is not None:
+        received = request.authorization.password
+    if (
+        not secret
+        or received is None
+        or not hmac.compare_digest(secret.encode(), received.encode())
+    ):
+        return {"error": "invalid secret"}, 403
+
+    try:
+        submission = kobo.normalize_submission(request.get_json(silent=True))
+    except (ValueError, TypeError) as e:
+        return {"error": str(e)}, 400
+    kobo.add_submission(submission)
+    refresh_data(sync=False, join=False)
+    return {"_id": submission["_id"]}, 200
 
 
 @app.route("/data", methods=["POST"])
@@ -484,110 +687,167 @@ def default_page():
         return render_template("home.html")
 
 
-@app.route("/dataupdate", methods=["POST"])
+@app.route("/dataupdate", methods=["GET", "POST"])
 def update_bracelet():
     """
     get bracelet number and show patient info
     """
-    if "bracelet" in request.form.keys():
-        bracelet_number = request.form["bracelet"]
-    else:
-        bracelet_number = None
+    bracelet_number = request.values.get("bracelet")
     df_form, rotation_no = get_data()
-    return process_data(df_form, bracelet_number)
+    if bracelet_number and get_patient(df_form, bracelet_number).empty:
+        # patient may have been registered after the last refresh: show the
+        # suggestions now, and sync in the background for the next lookup
+        request_refresh()
+    return cached_page(
+        df_form,
+        ("data", bracelet_number),
+        lambda: process_data(df_form, bracelet_number),
+    )
+
+
+@app.route("/search")
+def patient_search():
+    """
+    find patients by bracelet number prefix, name or diagnosis, as JSON for
+    type-ahead
+    """
+    df_form, rotation_no = get_data()
+    limit = max(1, min(request.args.get("limit", SEARCH_LIMIT, type=int), 100))
+    return jsonify(search_patients(df_form, request.args.get("q", ""), limit))
+
+
+@app.route("/cards", methods=["GET", "POST"])
+def patient_cards():
+    """
+    show information, consultations and referral status of all patients, or
+    of the bracelet numbers given, on a single page to print
+    """
+    df_form, rotation_no = get_data()
+    bracelet_numbers = request.values.get("bracelets", "").replace(",", " ").split()
+
+    def render():
+        df = get_patients(df_form, bracelet_numbers or None)
+        return render_template("cards.html", timelines=build_timelines(df))
 
+    return cached_page(df_form, ("cards", tuple(bracelet_numbers)), render)
 
-@app.route("/summary", methods=["POST"])
+
+@app.route("/summary", methods=["GET", "POST"])
 def summary():
     """
     show summary of morbidities
     """
     df_form, rotation_no = get_data()
-    return process_summary(df_form)
+    # the current rotation, unless a valid rotation number is given
+    rotation = request.values.get("rotation", type=int)
+    return cached_page(
+        df_form,
+        ("summary", rotation),
+        lambda: process_summary(df_form, rotation_no, rotation),
+    )
 
 
-@app.route("/")
-def login_page():
+@app.route("/trends", methods=["GET", "POST"])
+def trends():
     """
-    login page
+    show consultations, patients, referrals and morbidities of all rotations
     """
-    return render_template("home.html")
+    df_form, rotation_no = get_data()
+    return cached_page(
+        df_form,
+        ("trends",),
+        lambda: render_template("trends.html", table=cube.rotation_trends()),
+    )
 
 
-def case_map(case):
-    """
-    map KoBo XLS column names to human-readable format
-    """
-    case_map_dict = {
-        "male": "Male",
-        "female": "Female",
-        "other": "Other",
-        "u1": "Less than 1 year",
-        "1_4": "1-4 years",
-        "5_17": "5-17 years",
-        "18_50": "18-50 years",
-        "50p": "50+ years",
-        "scabies": "Scabies",
-        "sea_sickness": "Sea sickness",
-        "herpes": "Herpes lip / cold sore",
-        "skin": "Other skin condition",
-        "gastritis": "Gastritis",
-        "dental": "Dental",
-        "injury": "Non-violence related injury",
-        "violence": "Violence related injury",
-        "fuel_burn": "Fuel burns",
-        "exposure_skin": "Exposure related skin disorder",
-        "dehydration": "Dehydration",
-        "hypothermia": "Hypothermia",
-        "body_pain": "Generalized body pain / headache",
-        "awd": "Acute watery diarrhoea",
-        "nicotine": "Nicotine withdrawal",
-        "sawd": "Severe acute diarrhoea",
-        "abd": "Acute bloody diarrhoea",
-        "chronic_diarrhoea": "Chronic diarrhoea",
-        "const": "Constipation",
-        "fever": "Fever without identified cause",
-        "urti": "Acute upper respiratory tract infection / common cold",
-        "lrti": "Acute lower respiratory tract infection",
-        "tb": "Tuberculosis (suspected)",
-        "meningitis": "Meningitis (suspected)",
-        "std": "Sexually transmitted infection (suspected)",
-        "uti": "Urinary tract infection",
-        "eye": "Eye infection",
-        "gyno": "Gynaecological disorder",
-        "anaemia": "Anaemia",
-        "malnutrition": "Severe acute malnutrition",
-        "chronic": "Chronic disease",
-        "cpd": "Mental health presentation",
-        "spd": "Severe psychiatric disorder",
-        "covid": "Confirmed COVID-19",
-        "sv": "SV/SGBV",
-        "pregnancy": "Pregnancy related (ANC & PNC)",
-        "pregnancy_anc": "Pregnancy ANC",
-        "pregnancy_pnc": "Pregnancy PNC",
-        "baby": "Baby consultation",
-        "yes": "yes",
-        "no": "no",
-    }
-    if case in case_map_dict.keys():
-        return case_map_dict[case]
-    else:
-        return case
+@app.route("/metrics")
+def show_metrics():
+    """
+    timings, sizes and cache hits of this worker in the Prometheus format
+    """
+    flights = _refresh_flights.stats()
+    df_form = next(iter(_data_cache.values()))[0] if _data_cache else pd.DataFrame()
+    data_age = inject_data_age().get("data_age")
+    extra = [
+        (
+            "app_refresh_calls_total",
+            "counter",
+            "Calls to refresh data",
+            flights["calls"],
+        ),
+        ("app_refresh_flights_total", "counter", "Refreshes run", flights["flights"]),
+        (
+            "app_refresh_coalesced_total",
+            "counter",
+            "Calls that shared a refresh in progress",
+            flights["coalesced"],
+        ),
+        (
+            "app_refresh_in_flight",
+            "gauge",
+            "Refreshes in progress",
+            flights["in_flight"],
+        ),
+        ("app_data_rows", "gauge", "Submissions of the current rotation", len(df_form)),
+    ]
+    if data_age is not None:
+        extra.append(
+            ("app_data_age_minutes", "gauge", "Minutes since the last sync", data_age)
+        )
+    return Response(
+        metrics.render(extra), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
 
 
-def map_age(age):
+@app.before_request
+def start_request_metrics():
     """
-    map KoBo XLS column names to human-readable format
+    start timing the request
     """
-    age_dict = {
-        "u1": "less than 1 year",
-        "1_4": "1-4 years",
-        "5_12": "5-12 years",
-        "13_17": "13-17 years",
-        "18_50": "18-50 years",
-        "50p": "50+ years",
-    }
-    if age in age_dict.keys():
-        return age_dict[age]
-    else:
-        return age
+    metrics.start_request()
+
+
+@app.after_request
+def finish_request_metrics(response):
+    """
+    report the duration and size of the request, and log it if slow
+    """
+    size = None if response.is_streamed else response.calculate_content_length()
+    metrics.finish_request(request.endpoint or "unknown", size, SLOW_REQUEST_SECONDS)
+    return response
+
+
+# registered after the metrics, so that it runs before them and the size
+# reported is the size sent
+@app.after_request
+def compress_response(response):
+    """
+    gzip text and JSON responses, for the satellite link
+    """
+    return pages.compress(response)
+
+
+@before_render_template.connect_via(app)
+def start_render_metrics(sender, template, context, **extra):
+    """
+    start timing the rendering of a template
+    """
+    g.render_started_at = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def finish_render_metrics(sender, template, context, **extra):
+    """
+    report the time to render a template
+    """
+    started_at = g.pop("render_started_at", None)
+    if started_at is not None:
+        metrics.record(f"render {template.name}", time.perf_counter() - started_at)
+
+
+@app.route("/")
+def login_page():
+    """
+    login page
+    """
+    return render_template("home.html")
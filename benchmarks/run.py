@@ -0,0 +1,332 @@
+import argparse
+import inspect
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from werkzeug.exceptions import MethodNotAllowed, NotFound
+
+from benchmarks import standins, synthetic
+
+# days covered by the synthetic submissions and rotation sheet
+DAYS = 365
+
+# KoBo server hardcoded in the original app
+KOBO_SERVER = "https://kobo.ifrc.org"
+
+
+def timed(name, fn, repeat, store):
+    """
+    run fn repeat times and summarize its durations in seconds, with the
+    requests it made to the stand-ins
+    """
+    durations, result = [], None
+    requests = store.requests
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        result = fn()
+        durations.append(time.perf_counter() - started_at)
+    status = getattr(result, "status_code", None)
+    print(f"  {name}: {statistics.median(durations):.4f}s", file=sys.stderr)
+    return {
+        "name": name,
+        "repeat": repeat,
+        "status": status,
+        "min": min(durations),
+        "median": statistics.median(durations),
+        "mean": statistics.mean(durations),
+        "max": max(durations),
+        "upstream_requests": (store.requests - requests) / repeat,
+    }
+
+
+def redirect_upstream(standin_url):
+    """
+    send the requests of an app that hardcodes KoBo and Google Sheets, like
+    the original one, to the stand-ins
+    """
+    import googleapiclient.discovery
+    import requests
+
+    send = requests.Session.request
+
+    def request(self, method, url, *args, **kwargs):
+        if url.startswith(KOBO_SERVER):
+            url = standin_url + url[len(KOBO_SERVER) :]
+        return send(self, method, url, *args, **kwargs)
+
+    requests.Session.request = request
+    build = googleapiclient.discovery.build
+
+    def build_standin(*args, **kwargs):
+        client_options = {"api_endpoint": f"{standin_url}/"}
+        return build(*args, client_options=client_options, **kwargs)
+
+    googleapiclient.discovery.build = build_standin
+
+
+def routed(app, method, path):
+    """
+    whether the app has a route for method and path
+    """
+    try:
+        app.app.url_map.bind("localhost").match(path, method.upper())
+    except (NotFound, MethodNotAllowed):
+        return False
+    return True
+
+
+def run_size(size, repeat, app_path=None):
+    """
+    time the routes and core functions with size synthetic submissions, in
+    this process; the app is imported once the stand-ins are running, from
+    app_path if given, and measures it does not support are left out
+    """
+    submissions = synthetic.make_submissions(size, days=DAYS)
+    store = standins.Store(submissions, synthetic.make_rotations(days=DAYS))
+    server, url = standins.start(store)
+    directory = tempfile.mkdtemp(prefix="benchmark-")
+    os.environ.update(
+        {
+            "KOBO_URL": url,
+            "TOKEN": "benchmark",
+            "ASSET": "benchmark",
+            "GOOGLESHEETID": "benchmark",
+            "GOOGLESERVICEACCUNT": json.dumps(standins.service_account(url)),
+            "SHEETS_URL": f"{url}/",
+            "SNAPSHOT_PATH": os.path.join(directory, "snapshot.sqlite3"),
+            "PASSWORD": "benchmark",
+            "KOBO_HOOK_SECRET": "benchmark",
+            "REFRESH_INTERVAL": "1000000",
+        }
+    )
+    os.environ.pop("SHARED_DATA_DIR", None)
+    if app_path is not None:
+        redirect_upstream(url)
+        sys.path.insert(0, os.path.abspath(app_path))
+        # the original app writes its exports to the working directory and
+        # sends them from its own
+        os.chdir(app_path)
+
+    import app
+
+    results = [timed("get_data (first sync)", app.get_data, 1, store)]
+    results.append(timed("get_data", app.get_data, repeat, store))
+    if hasattr(app, "refresh_data"):
+        results.append(
+            timed("refresh_data (no change)", app.refresh_data, repeat, store)
+        )
+    df_form, rotation_no = app.get_data()
+    counts = df_form["bracelet_number"].astype(object).value_counts()
+    frequent, typical = counts.index[0], counts.index[len(counts) // 2]
+    bracelets = " ".join(counts.index[:20])
+    latest = submissions[-1]
+
+    with app.app.test_request_context():
+        results.append(
+            timed(
+                "process_data (frequent patient)",
+                lambda: app.process_data(df_form, frequent),
+                repeat,
+                store,
+            )
+        )
+        results.append(
+            timed(
+                "process_data (typical patient)",
+                lambda: app.process_data(df_form, typical),
+                repeat,
+                store,
+            )
+        )
+        # the original app summarizes the current rotation only
+        parameters = len(inspect.signature(app.process_summary).parameters)
+        rotation = [rotation_no] if parameters > 1 else []
+        results.append(
+            timed(
+                "process_summary",
+                lambda: app.process_summary(df_form, *rotation),
+                repeat,
+                store,
+            )
+        )
+        if parameters > 2:
+            results.append(
+                timed(
+                    "process_summary (past rotation)",
+                    lambda: app.process_summary(df_form, rotation_no, rotation_no - 1),
+                    repeat,
+                    store,
+                )
+            )
+
+    client = app.app.test_client()
+    hook = {"X-Kobo-Hook-Secret": "benchmark"}
+    etag = client.get("/summary").headers.get("ETag", "")
+    routes = [
+        ("GET /", "get", "/", {}),
+        ("POST /data", "post", "/data", {"data": {"password": "benchmark"}}),
+        ("POST /dataupdate", "post", "/dataupdate", {"data": {"bracelet": typical}}),
+        ("POST /summary", "post", "/summary", {}),
+        (
+            "POST /summary (past rotation)",
+            "post",
+            "/summary",
+            {"data": {"rotation": str(rotation_no - 1)}},
+        ),
+        (
+            "GET /summary (not modified)",
+            "get",
+            "/summary",
+            {"headers": {"If-None-Match": etag}},
+        ),
+        ("POST /trends", "post", "/trends", {}),
+        (
+            "POST /cards (20 patients)",
+            "post",
+            "/cards",
+            {"data": {"bracelets": bracelets}},
+        ),
+        ("GET /search", "get", f"/search?q={typical[:2]}", {}),
+        ("GET /metrics", "get", "/metrics", {}),
+        (
+            "POST /downloaddata (xlsx)",
+            "post",
+            "/downloaddata",
+            {"data": {"format": "xlsx"}},
+        ),
+        (
+            "POST /downloaddata (csv)",
+            "post",
+            "/downloaddata",
+            {"data": {"format": "csv"}},
+        ),
+        (
+            "POST /downloaddata (parquet)",
+            "post",
+            "/downloaddata",
+            {"data": {"format": "parquet"}},
+        ),
+        ("POST /updatesubmissions (form)", "post", "/updatesubmissions", {}),
+        (
+            "POST /updatesubmission",
+            "post",
+            "/updatesubmission",
+            {"data": {"bracelet": typical, "referral": "Referral is needed, urgent"}},
+        ),
+        (
+            "POST /updatesubmissions",
+            "post",
+            "/updatesubmissions",
+            {
+                "data": {
+                    "bracelet": list(counts.index[:5]),
+                    "referral": ["Referral is not needed"] * 5,
+                }
+            },
+        ),
+        ("POST /kobo-hook", "post", "/kobo-hook", {"json": latest, "headers": hook}),
+    ]
+    for name, method, path, kwargs in routes:
+        if not routed(app, method, path):
+            continue
+        data = kwargs.get("data", {})
+        if data.get("format") not in [None, "xlsx"] and not hasattr(app, "export"):
+            # the original app exports xlsx whatever the format asked
+            continue
+        if "rotation" in data and parameters < 3:
+            continue
+        results.append(
+            timed(name, lambda: getattr(client, method)(path, **kwargs), repeat, store)
+        )
+    server.shutdown()
+    for result in results:
+        result["size"] = size
+    return results
+
+
+def get_meta():
+    """
+    versions and machine the benchmark ran on
+    """
+    import pandas as pd
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(results, baseline):
+    """
+    print the median of each result against the same result of a baseline
+    """
+    previous = {(x["size"], x["name"]): x["median"] for x in baseline["results"]}
+    for result in results:
+        before = previous.get((result["size"], result["name"]))
+        ratio = "" if not before else f"{before / result['median']:.2f}x"
+        print(
+            f"{result['size']:>7} {result['name']:<40} {result['median']:.4f}s {ratio}",
+            file=sys.stderr,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="time the app against local stand-ins of KoBo and Google Sheets"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="JSON file for the results")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument(
+        "--app", help="checkout of another version of the app to time instead"
+    )
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.size is not None:
+        # one size per process, so that each starts from an empty app
+        json.dump(run_size(args.size, args.repeat, args.app), sys.stdout)
+        return
+
+    results = []
+    for size in args.sizes:
+        print(f"{size} submissions", file=sys.stderr)
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.run", "--size", str(size)]
+            + ["--repeat", str(args.repeat)]
+            + (["--app", args.app] if args.app else []),
+            stdout=subprocess.PIPE,
+            check=True,
+            text=True,
+        ).stdout
+        results += json.loads(output)
+    report = {"meta": get_meta(), "results": results}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import rsa
+
+# submissions in a page of KoBo data when the request sets no limit, as many
+# as KoBo serves at most
+MAX_LIMIT = 30000
+
+
+class Store:
+    """
+    submissions and rotation sheet served by the stand-in servers
+    """
+
+    def __init__(self, submissions, rotations):
+        self.submissions = {x["_id"]: x for x in submissions}
+        self.rotations = rotations
+        self.lock = threading.Lock()
+        self.requests = 0
+        # ids of submissions that bulk updates fail to update
+        self.rejected = set()
+        # seconds before answering a request for data, and number of them
+        # answered before the others fail (None: they never do)
+        self.delay = 0
+        self.failing_after = None
+
+
+def _query(params, submissions):
+    """
+    submissions matching the query and fields of a KoBo data request
+    """
+    rows = [submissions[x] for x in sorted(submissions.keys())]
+    if params.get("query"):
+        query = json.loads(params["query"]).get("_id", {})
+        if "$gt" in query.keys():
+            rows = [x for x in rows if x["_id"] > query["$gt"]]
+        if "$in" in query.keys():
+            ids = set(query["$in"])
+            rows = [x for x in rows if x["_id"] in ids]
+    if params.get("fields"):
+        fields = json.loads(params["fields"])
+        rows = [{k: x[k] for k in fields if k in x.keys()} for x in rows]
+    return rows
+
+
+def make_handler(store):
+    """
+    request handler of the KoBo v2 data and bulk update APIs, the Google
+    Sheets values API and the Google OAuth token endpoint
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, data, status=200):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def read_body(self):
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if url.path.endswith("/data.json"):
+                time.sleep(store.delay)
+            with store.lock:
+                store.requests += 1
+                if url.path.endswith("/data.json"):
+                    if store.failing_after is not None:
+                        if store.failing_after <= 0:
+                            return self.send_json({"detail": "server error"}, 500)
+                        store.failing_after -= 1
+                    rows = _query(params, store.submissions)
+                    start = int(params.get("start", 0))
+                    limit = int(params.get("limit", MAX_LIMIT))
+                    next_url = None
+                    if start + limit < len(rows):
+                        query = urlencode({**params, "start": start + limit})
+                        next_url = f"http://{self.headers['Host']}{url.path}?{query}"
+                    page = {
+                        "count": len(rows),
+                        "next": next_url,
+                        "results": rows[start : start + limit],
+                    }
+                    return self.send_json(page)
+                if "/values/" in url.path:
+                    return self.send_json({"values": store.rotations})
+            self.send_json({"detail": "not found"}, 404)
+
+        def do_PATCH(self):
+            url = urlparse(self.path)
+            body = {k: v[0] for k, v in parse_qs(self.read_body().decode()).items()}
+            if not url.path.endswith("/data/bulk/"):
+                return self.send_json({"detail": "not found"}, 404)
+            payload = json.loads(body["payload"])
+            results = []
+            with store.lock:
+                store.requests += 1
+                for submission_id in payload["submission_ids"]:
+                    submission = dict(store.submissions[int(submission_id)])
+                    if int(submission_id) in store.rejected:
+                        results.append(
+                            {"uuid": submission["_uuid"], "status_code": 400}
+                        )
+                        continue
+                    submission.update(payload["data"])
+                    submission["meta/instanceID"] += "-edited"
+                    store.submissions[int(submission_id)] = submission
+                    results.append({"uuid": submission["_uuid"], "status_code": 201})
+            # like KoBo: 200 if any submission was updated
+            successes = sum(x["status_code"] == 201 for x in results)
+            result = {
+                "count": len(results),
+                "successes": successes,
+                "failures": len(results) - successes,
+                "results": results,
+            }
+            self.send_json(result, 200 if successes else 400)
+
+        def do_POST(self):
+            self.read_body()
+            if self.path.startswith("/token"):
+                token = {"access_token": "benchmark", "expires_in": 3600}
+                return self.send_json({**token, "token_type": "Bearer"})
+            self.send_json({"detail": "not found"}, 404)
+
+    return Handler
+
+
+def start(store):
+    """
+    serve the stand-ins on a free local port in a background thread; return
+    the server and its url
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(store))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def service_account(url):
+    """
+    Google service account credentials that get their token from the
+    stand-in server
+    """
+    _, private_key = rsa.newkeys(1024)
+    return {
+        "type": "service_account",
+        "project_id": "benchmark",
+        "private_key_id": "benchmark",
+        "private_key": private_key.save_pkcs1().decode(),
+        "client_email": "benchmark@benchmark.iam.gserviceaccount.com",
+        "client_id": "0",
+        "token_uri": f"{url}/token",
+    }
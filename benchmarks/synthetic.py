@@ -0,0 +1,116 @@
+import os
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from labels import get_form_path, parse_form
+
+# submissions per patient follow a long tail: most patients are seen once or
+# twice, a few dozens of times
+PATIENT_WEIGHT = 1.2
+
+NAMES = ["Amadou", "Fatima", "Ibrahim", "Aisha", "Moussa", "Mariam", "Yusuf", "Sara"]
+TREATMENTS = ["paracetamol", "ibuprofen", "ORS", "permethrin", "dressing", None]
+
+# days in each rotation of the synthetic rotation sheet
+ROTATION_DAYS = 21
+
+
+def get_choices(path=None):
+    """
+    codes of the choices of each select field of the XLSForm
+    """
+    form = parse_form(path or get_form_path())
+    return {
+        field: list(form["choices"].get(list_name, {}).keys())
+        for field, list_name in form["fields"].items()
+        if list_name is not None
+    }
+
+
+def make_submissions(n, days=365, seed=0, end=None, path=None):
+    """
+    n submissions shaped like the KoBo v2 data of the medical form, spread
+    over the days before end, with three consultations per patient on average
+    """
+    rnd = random.Random(seed)
+    choices = get_choices(path)
+    cases = [x for x in choices["primary_case"] if x != "other"]
+    end = end or datetime.now(timezone.utc)
+    n_patients = max(1, n // 3)
+    weights = [1 / (x + 1) ** PATIENT_WEIGHT for x in range(n_patients)]
+    patients = rnd.choices(range(n_patients), weights=weights, k=n)
+    bracelets = rnd.sample(range(1, 10 * n_patients + 1), n_patients)
+    people = {}
+    submissions = []
+    for ix, patient in enumerate(patients):
+        if patient not in people.keys():
+            people[patient] = {
+                "bracelet_number": str(bracelets[patient]),
+                "name": rnd.choice(NAMES),
+                "gender": rnd.choice(choices["gender"]),
+                "age": rnd.choice(choices["age"]),
+            }
+        person = people[patient]
+        start = end - timedelta(days=days) + timedelta(days=days * ix / n)
+        submission = {
+            "_id": ix + 1,
+            "_uuid": str(uuid.UUID(int=rnd.getrandbits(128))),
+            "_submission_time": (start + timedelta(minutes=15)).strftime(
+                "%Y-%m-%dT%H:%M:%S"
+            ),
+            "_xform_id_string": os.getenv("ASSET", "benchmark"),
+            "_attachments": [],
+            "_geolocation": [None, None],
+            "_status": "submitted_via_web",
+            "_validation_status": {},
+            "_notes": [],
+            "_tags": [],
+            "_submitted_by": None,
+            "__version__": "v1",
+            "formhub/uuid": "benchmark",
+            "start": start.isoformat(timespec="milliseconds"),
+            "end": (start + timedelta(minutes=10)).isoformat(timespec="milliseconds"),
+            **person,
+        }
+        submission["meta/instanceID"] = f"uuid:{submission['_uuid']}"
+        levels = ["primary"]
+        if rnd.random() < 0.4:
+            levels.append("secondary")
+            submission["is_secondary"] = "yes"
+            if rnd.random() < 0.3:
+                levels.append("tertiary")
+                submission["is_tertiary"] = "yes"
+        for level in levels:
+            case = "other" if rnd.random() < 0.05 else rnd.choice(cases)
+            submission[level + "_case"] = case
+            if case == "other":
+                submission[level + "_case_other"] = rnd.choice(["Rash", "Cut", "Burn"])
+            elif f"extra_information_{case}" in choices.keys():
+                submission[f"extra_information_{case}"] = rnd.choice(["yes", "no"])
+        submission["referral"] = "yes" if rnd.random() < 0.3 else "no"
+        if submission["referral"] == "yes":
+            submission["referral_urgency"] = rnd.choice(choices["referral_urgency"])
+        treatment = rnd.choice(TREATMENTS)
+        if treatment is not None:
+            submission["treatment"] = treatment
+        submissions.append(submission)
+    return submissions
+
+
+def make_rotations(days=365, end=None):
+    """
+    values of a rotation sheet covering the days before end, with the last
+    rotation still going on
+    """
+    end = (end or datetime.now(timezone.utc)).date()
+    start = end - timedelta(days=days)
+    values = [["Rotation No", "Start date", "End date"]]
+    number = 1
+    while start <= end:
+        last = start + timedelta(days=ROTATION_DAYS - 1)
+        values.append(
+            [str(number), start.strftime("%d/%m/%Y"), last.strftime("%d/%m/%Y")]
+        )
+        start, number = last + timedelta(days=1), number + 1
+    return values
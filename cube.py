@@ -0,0 +1,150 @@
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+import kobo
+import snapshot
+from summary import LABELS, SummaryState, aggregate_summary
+
+# rotation of each submission, rotation numbers and store version the cube
+# was last updated with, and summary of each rotation kept up to date
+_assigned = None
+_numbers = set()
+_version = None
+_states = {}
+_lock = threading.Lock()
+
+
+def cube_rows(summary, rotation_no):
+    """
+    rows of the summary cube of a rotation, from its summary like
+    aggregate_summary: consultations, patients, morbidities by demographic
+    label and referrals by urgency
+    """
+    consultations, patients, morbidities, referrals = summary
+    rows = [
+        (rotation_no, "consultations", "", "", int(consultations), 0),
+        (rotation_no, "patients", "", "", int(patients), 0),
+    ]
+    for position, (case, counts) in enumerate(morbidities.items()):
+        for label, value in counts.items():
+            # bracelet numbers are listed as text
+            value = value if isinstance(value, str) else int(value)
+            rows.append((rotation_no, "morbidity", case, label, value, position))
+    for position, (key, value) in enumerate(referrals.items()):
+        rows.append((rotation_no, "referral", key, "", int(value), position))
+    return rows
+
+
+def update_cube(df_all, numbers, version):
+    """
+    recompute the cube of the rotations whose submissions changed since the
+    last update (all of them the first time) and save it in the snapshot;
+    df_all has the rotation of every submission in rotation_no
+    """
+    global _assigned, _numbers, _version, _states
+    assigned = pd.Series(df_all["rotation_no"].array, index=df_all["_id"].to_numpy())
+    numbers = {int(x) for x in numbers}
+    with _lock:
+        changes = None if _version is None else kobo.get_changes(_version)
+        if changes is None:
+            update = numbers
+            _states = {}
+        else:
+            # changed submissions, and those moved by a change of the rotations
+            previous = _assigned.reindex(assigned.index)
+            moved = previous.fillna(0).to_numpy() != assigned.fillna(0).to_numpy()
+            ids = list(changes | set(assigned.index[moved]))
+            update = set(assigned.reindex(ids).dropna()) | set(
+                _assigned.reindex(ids).dropna()
+            )
+            update = ({int(x) for x in update} | (numbers - _numbers)) & numbers
+
+        positions = None
+        rows = []
+        for rotation_no in sorted(update):
+            state = _states.get(rotation_no)
+            if state is None:
+                if positions is None:
+                    positions = df_all.groupby("rotation_no", observed=True).indices
+                df = df_all.iloc[positions.get(rotation_no, [])]
+                if changes is None:
+                    rows += cube_rows(aggregate_summary(df), rotation_no)
+                    continue
+                # rotations that change once usually change again, e.g. the
+                # current one: their summary is kept and updated from now on
+                state = _states[rotation_no] = SummaryState.from_data(df)
+            else:
+                # only the submissions that changed, or moved in or out
+                df = df_all[df_all["_id"].isin(ids)]
+                df = df[(df["rotation_no"] == rotation_no).fillna(False)]
+                state.remove(set(ids) - set(df["_id"]))
+                state.upsert(df)
+            rows += cube_rows(state.summary(), rotation_no)
+        for rotation_no in _numbers - numbers:
+            _states.pop(rotation_no, None)
+        snapshot.save_cube(
+            rows,
+            update | (_numbers - numbers),
+            replace=changes is None,
+        )
+        _assigned, _numbers, _version = assigned, numbers, version
+
+
+def rotation_summary(rotation_no):
+    """
+    consultations, patients, morbidities and referrals of a rotation from
+    the cube, like aggregate_summary; None if it is not in the cube
+    """
+    rows = snapshot.load_cube(rotation_no)
+    if not rows:
+        return None
+    totals = {"consultations": 0, "patients": 0}
+    morbidities, referrals = OrderedDict(), {}
+    for _, measure, key, label, value, _ in sorted(rows, key=lambda x: x[5]):
+        if measure in totals.keys():
+            totals[measure] = value
+        elif measure == "morbidity":
+            morbidities.setdefault(key, {})[label] = value
+        elif measure == "referral":
+            referrals[key] = value
+    for case, counts in morbidities.items():
+        ordered = {x: counts.get(x, 0) for x in LABELS}
+        if "bracelet" in counts.keys():
+            ordered["bracelet"] = counts["bracelet"]
+        morbidities[case] = ordered
+    return totals["consultations"], totals["patients"], morbidities, referrals
+
+
+def rotation_nos():
+    """
+    rotations in the cube, latest first
+    """
+    return sorted({x[0] for x in snapshot.load_cube()}, reverse=True)
+
+
+def rotation_trends():
+    """
+    consultations, patients, referrals needed and total of each morbidity
+    (most frequent first) for every rotation in the cube
+    """
+    df = pd.DataFrame(
+        snapshot.load_cube(),
+        columns=["rotation_no", "measure", "key", "label", "value", "position"],
+    )
+    if df.empty:
+        return pd.DataFrame()
+    df = df[(df["measure"] != "morbidity") | (df["label"] == "total")]
+    df = df[(df["measure"] != "referral") | (df["key"] == "Referrals needed")]
+    names = {"consultations": "Medical consultations", "patients": "Patients"}
+    df["name"] = df["measure"].map(names).fillna(df["key"])
+    df["value"] = pd.to_numeric(df["value"])
+    table = df.pivot_table(
+        index="name", columns="rotation_no", values="value", aggfunc="sum"
+    )
+    totals = ["Medical consultations", "Patients", "Referrals needed"]
+    cases = df.loc[df["measure"] == "morbidity", "name"].unique()
+    cases = table.loc[cases].sum(axis=1).sort_values(ascending=False, kind="stable")
+    table = table.reindex([x for x in totals if x in table.index] + list(cases.index))
+    return table.fillna(0).astype(int)
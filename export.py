@@ -0,0 +1,154 @@
+import io
+
+import pandas as pd
+import xlsxwriter
+
+from labels import age_labels, case_labels, translate
+
+# columns of the exported data, in order
+EXPORT_COLUMNS = [
+    "_submission_time",
+    "bracelet_number",
+    "name",
+    "gender",
+    "age",
+    "diagnosis",
+    "history",
+    "vital_signs",
+    "treatment",
+    "info",
+    "referral_urgency",
+]
+
+EXPORT_FORMATS = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def parse_date(value):
+    """
+    date of a filter in UTC, None if not given; raise ValueError if it is
+    not a date
+    """
+    if value is None:
+        return None
+    date = pd.to_datetime(value, utc=True)
+    if pd.isna(date):
+        raise ValueError(f"not a date: {value}")
+    return date
+
+
+def filter_data(df_form, rotation=None, start_date=None, end_date=None):
+    """
+    keep submissions of a rotation and/or between two dates (inclusive)
+    """
+    if df_form.empty:
+        return df_form
+    mask = pd.Series(True, index=df_form.index)
+    if rotation is not None:
+        if "rotation_no" not in df_form.columns:
+            return df_form.iloc[0:0]
+        mask &= (df_form["rotation_no"] == rotation).fillna(False)
+    if start_date is not None:
+        mask &= df_form["start"] >= pd.to_datetime(start_date, utc=True)
+    if end_date is not None:
+        end = pd.to_datetime(end_date, utc=True) + pd.Timedelta(days=1)
+        mask &= df_form["start"] < end
+    return df_form[mask]
+
+
+def referral_data(df_form):
+    """
+    data of referrals, with human-readable age and diagnoses
+    """
+    if "referral" not in df_form.columns:
+        return pd.DataFrame(columns=EXPORT_COLUMNS)
+
+    # keep only referrals
+    df = df_form[df_form["referral"] == "yes"].copy()
+
+    # change age
+    df["age"] = translate(df["age"], age_labels())
+
+    # merge diagnoses
+    diagnosis = translate(df["primary_case"], case_labels())
+    for case_key in ["secondary_case", "tertiary_case"]:
+        if case_key in df.columns:
+            case = translate(df[case_key], case_labels())
+            diagnosis = diagnosis.where(case.isna(), diagnosis + ", " + case)
+    df["diagnosis"] = diagnosis
+
+    # keep only meaningful columns
+    df = df[[x for x in EXPORT_COLUMNS if x in df.columns]]
+
+    # order by bracelet number
+    df["bracelet_number"] = df["bracelet_number"].astype(float, errors="ignore")
+    return df.sort_values(by="bracelet_number")
+
+
+def write_excel(df):
+    """
+    write df to an Excel file in memory, one row at a time
+    """
+    buffer = io.BytesIO()
+    workbook = xlsxwriter.Workbook(
+        buffer,
+        {"constant_memory": True, "default_date_format": "yyyy-mm-dd hh:mm:ss"},
+    )
+    worksheet = workbook.add_worksheet("DATA")
+    header_format = workbook.add_format(
+        {"bold": True, "border": 1, "align": "center", "valign": "top"}
+    )
+
+    # Excel has no timezones; Arrow timestamps are made numpy ones, so that
+    # columns are as wide on every worker
+    for col in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[col].dtype):
+            values = df[col]
+            if values.dt.tz is not None:
+                values = values.dt.tz_localize(None)
+            df = df.assign(**{col: values.astype("datetime64[ns]")})
+
+    # set column width to the longest item or column name
+    for idx, col in enumerate(df.columns):
+        max_len = len(col)
+        if not df.empty:
+            max_len = max(max_len, df[col].astype(str).str.len().max())
+        worksheet.set_column(idx, idx, max_len + 1)
+
+    worksheet.write_row(0, 0, df.columns, header_format)
+    df = df.astype(object).where(df.notna(), None)
+    for row, values in enumerate(df.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(row, 0, values)
+    workbook.close()
+    buffer.seek(0)
+    return buffer
+
+
+def write_csv(df):
+    """
+    write df to a CSV file in memory
+    """
+    buffer = io.BytesIO()
+    df.to_csv(buffer, index=False, encoding="utf-8")
+    buffer.seek(0)
+    return buffer
+
+
+def write_parquet(df):
+    """
+    write df to a Parquet file in memory
+    """
+    buffer = io.BytesIO()
+    text_columns = df.select_dtypes(["object", "category"]).columns
+    df = df.astype({x: str for x in text_columns}).where(df.notna(), None)
+    # attrs would be stored in the file metadata
+    df.attrs = {}
+    df.to_parquet(buffer, index=False)
+    buffer.seek(0)
+    return buffer
+
+
+writers = {"xlsx": write_excel, "csv": write_csv, "parquet": write_parquet}
@@ -0,0 +1,439 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+import snapshot
+
+logger = logging.getLogger(__name__)
+
+# KoBo metadata dropped from submissions as soon as they are downloaded
+UNUSED_FIELDS = {
+    "_attachments",
+    "_geolocation",
+    "_validation_status",
+    "_notes",
+    "_tags",
+    "_status",
+    "_submitted_by",
+    "_xform_id_string",
+    "formhub/uuid",
+    "meta/deprecatedID",
+    "meta/rootUuid",
+    "__version__",
+}
+
+# edited submissions are downloaded in batches, to keep urls short
+EDITED_BATCH_SIZE = 100
+
+# number of store versions for which changed submissions are remembered
+CHANGES_KEPT = 100
+
+# local store of KoBo submissions, keyed by _id
+_submissions = {}
+_revisions = {}
+_high_water_mark = 0
+_version = 0
+_changes = []
+_synced_at = None
+_store_lock = threading.RLock()
+# held for a whole sync with KoBo, during which the local store stays
+# available: it is only locked to apply each page
+_sync_lock = threading.Lock()
+_session = None
+
+# whether this worker holds the local store; other workers hand their
+# changes over through the snapshot, numbered in order
+_held = False
+_pending_written = 0
+_pending_applied = 0
+
+
+def get_session():
+    """
+    get a pooled HTTP session that retries failed connections, but not
+    requests that timed out
+    """
+    global _session
+    if _session is None:
+        session = requests.Session()
+        retry = Retry(connect=10, read=0, backoff_factor=0.5)
+        adapter = HTTPAdapter(max_retries=retry)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update({"Authorization": f'Token {os.getenv("TOKEN")}'})
+        _session = session
+    return _session
+
+
+def asset_url():
+    """
+    url of the KoBo form
+    """
+    kobo_url = os.getenv("KOBO_URL", "https://kobo.ifrc.org")
+    return f'{kobo_url}/api/v2/assets/{os.getenv("ASSET")}'
+
+
+def data_url():
+    """
+    url of the KoBo data endpoint of the form
+    """
+    return f"{asset_url()}/data.json"
+
+
+def timeout():
+    """
+    seconds to wait for a response from KoBo
+    """
+    return float(os.getenv("KOBO_TIMEOUT", 60))
+
+
+def revision(submission):
+    """
+    identifier that changes every time a submission is edited
+    """
+    return submission.get("meta/instanceID", submission.get("_uuid"))
+
+
+def fetch_pages(query=None, fields=None):
+    """
+    get submissions from KoBo one page at a time, optionally filtered by a
+    mongo query; metadata we never use is dropped from each submission
+    """
+    params = {
+        "limit": int(os.getenv("KOBO_PAGE_SIZE", 1000)),
+        "sort": json.dumps({"_id": 1}),
+    }
+    if query is not None:
+        params["query"] = json.dumps(query)
+    if fields is not None:
+        params["fields"] = json.dumps(fields)
+    url = data_url()
+    while url is not None:
+        with metrics.span("kobo_fetch") as span:
+            data_request = get_session().get(url, params=params, timeout=timeout())
+            data = data_request.json()
+            if "results" not in data.keys():
+                raise ValueError(f"unexpected response from KoBo: {data}")
+            span["rows"] = len(data["results"])
+            span["bytes"] = len(data_request.content)
+        yield [
+            {k: v for k, v in x.items() if k not in UNUSED_FIELDS}
+            for x in data["results"]
+        ]
+        # the next url already contains all parameters
+        url, params = data.get("next"), None
+
+
+def fetch_submissions(query=None, fields=None):
+    """
+    get all submissions from KoBo, optionally filtered by a mongo query
+    """
+    return [x for page in fetch_pages(query, fields) for x in page]
+
+
+def _store(results):
+    """
+    add or replace submissions in the local store
+    """
+    global _high_water_mark
+    for submission in results:
+        _submissions[submission["_id"]] = submission
+        _revisions[submission["_id"]] = revision(submission)
+        _high_water_mark = max(_high_water_mark, submission["_id"])
+
+
+def _store_pages(pages, submission_ids):
+    """
+    add or replace submissions page by page, in the local store and in the
+    snapshot, as a new version of the store for each page; the ids of the
+    submissions stored so far are appended to submission_ids
+    """
+    # pages are downloaded while the store is unlocked
+    for page in pages:
+        if not page:
+            continue
+        page_ids = [x["_id"] for x in page]
+        with _store_lock:
+            _store(page)
+            _new_version(page_ids)
+        snapshot.save_submissions(page)
+        submission_ids += page_ids
+
+
+def _new_version(submission_ids):
+    """
+    increment the version of the local store, remembering which submissions
+    changed; None means that any submission may have changed
+    """
+    global _version
+    _version += 1
+    _changes.append((_version, None if submission_ids is None else set(submission_ids)))
+    del _changes[:-CHANGES_KEPT]
+
+
+def sync_submissions():
+    """
+    update the local store with new, edited and deleted submissions in KoBo;
+    return True if anything changed. Changes are applied as they are
+    downloaded, so the store holds those made before a failure; if another
+    sync is still running, return False at once
+    """
+    global _synced_at
+    if not _sync_lock.acquire(blocking=False):
+        return False
+    try:
+        changed = []
+        _sync_submissions(changed)
+        _synced_at = time.time()
+        snapshot.save_submissions([], synced_at=_synced_at)
+        return len(changed) > 0
+    finally:
+        _sync_lock.release()
+
+
+def _sync_submissions(changed):
+    """
+    sync the local store, appending the ids of the submissions stored or
+    deleted to changed as they are
+    """
+    with _store_lock:
+        known = list(_submissions.keys())
+        high_water_mark = _high_water_mark
+    if not known:
+        _store_pages(fetch_pages(), changed)
+    else:
+        # compare revisions of known submissions to find edits and deletions;
+        # submissions received from the webhook meanwhile are kept
+        remote = {
+            x["_id"]: revision(x)
+            for x in fetch_submissions(fields=["_id", "meta/instanceID", "_uuid"])
+        }
+        with _store_lock:
+            deleted = [x for x in known if x not in remote.keys() and x in _submissions]
+            for submission_id in deleted:
+                del _submissions[submission_id]
+                del _revisions[submission_id]
+            if deleted:
+                _new_version(deleted)
+            edited = [
+                x
+                for x, rev in _revisions.items()
+                if x in remote.keys() and remote[x] != rev
+            ]
+
+            # submissions below the high-water mark that were never stored,
+            # e.g. when a newer one was received from the webhook first
+            edited += [
+                x
+                for x in remote.keys()
+                if x not in _submissions and x < high_water_mark
+            ]
+        if deleted:
+            snapshot.save_submissions([], deleted)
+            changed += deleted
+
+        # submissions newer than the high-water mark, then edited ones
+        pages = [fetch_pages(query={"_id": {"$gt": high_water_mark}})]
+        for ix in range(0, len(edited), EDITED_BATCH_SIZE):
+            batch = edited[ix : ix + EDITED_BATCH_SIZE]
+            pages.append(fetch_pages(query={"_id": {"$in": batch}}))
+        _store_pages((x for y in pages for x in y), changed)
+
+
+def get_submissions(submission_ids=None):
+    """
+    get all submissions in the local store, or those of submission_ids that
+    it holds, ordered by _id
+    """
+    with _store_lock:
+        if submission_ids is None:
+            submission_ids = _submissions.keys()
+        return [_submissions[x] for x in sorted(submission_ids) if x in _submissions]
+
+
+def _failures(response):
+    """
+    number of submissions a bulk update of KoBo failed to update, None if
+    its response does not tell
+    """
+    try:
+        result = response.json()
+    except ValueError:
+        return None
+    if not isinstance(result, dict):
+        return None
+    if "failures" in result.keys():
+        return result["failures"]
+    if "results" in result.keys():
+        return sum(x.get("status_code") not in (200, 201) for x in result["results"])
+    return None
+
+
+def update_submissions(submission_ids, data):
+    """
+    update fields of submissions in KoBo with a single bulk request, then
+    apply the same update to the local store; return the ids of the
+    submissions that KoBo updated
+    """
+    submission_ids = [int(x) for x in submission_ids]
+    payload = {"submission_ids": [str(x) for x in submission_ids], "data": data}
+    with metrics.span("kobo_update") as span:
+        span["rows"] = len(submission_ids)
+        response = get_session().patch(
+            f"{asset_url()}/data/bulk/",
+            data={"payload": json.dumps(payload)},
+            params={"format": "json"},
+            timeout=timeout(),
+        )
+        response.raise_for_status()
+    if _failures(response) == 0:
+        _write_through(submission_ids, data)
+        return submission_ids
+
+    # KoBo answers 200 if any submission was updated: get those it updated,
+    # and keep the others as KoBo has them
+    submissions = fetch_submissions(query={"_id": {"$in": submission_ids}})
+    if not _held:
+        _hand_over(snapshot.save_submissions(submissions, pending=True))
+    else:
+        with _store_lock:
+            _store(submissions)
+            _new_version([x["_id"] for x in submissions])
+        snapshot.save_submissions(submissions)
+    return [
+        x["_id"] for x in submissions if all(x.get(k) == v for k, v in data.items())
+    ]
+
+
+def _write_through(submission_ids, data):
+    """
+    apply an update that KoBo made to submissions to the local store and
+    the snapshot
+    """
+    if not _held:
+        _hand_over(snapshot.update_submissions(submission_ids, data))
+        return
+    with _store_lock:
+        updated = []
+        for submission_id in submission_ids:
+            if submission_id in _submissions.keys():
+                submission = dict(_submissions[submission_id])
+                submission.update(data)
+                _submissions[submission_id] = submission
+                updated.append(submission)
+        if updated:
+            _new_version([x["_id"] for x in updated])
+            snapshot.save_submissions(updated)
+
+
+def normalize_submission(submission):
+    """
+    check a submission received from KoBo and drop metadata we never use
+    """
+    if not isinstance(submission, dict) or "_id" not in submission.keys():
+        raise ValueError("submission has no _id")
+    asset = submission.get("_xform_id_string")
+    if asset is not None and asset != os.getenv("ASSET"):
+        raise ValueError(f"submission belongs to another form: {asset}")
+    submission = {k: v for k, v in submission.items() if k not in UNUSED_FIELDS}
+    submission["_id"] = int(submission["_id"])
+    return submission
+
+
+def add_submission(submission):
+    """
+    add or replace a single submission in the local store and the snapshot
+    """
+    if not _held:
+        _hand_over(snapshot.save_submissions([submission], pending=True))
+        return
+    with _store_lock:
+        _store([submission])
+        _new_version([submission["_id"]])
+        snapshot.save_submissions([submission])
+
+
+def load_snapshot():
+    """
+    fill the local store with the submissions saved on disk; from then on,
+    this worker holds the local store
+    """
+    global _synced_at, _held
+    if _held:
+        return
+    submissions, synced_at = snapshot.load_submissions()
+    with _store_lock:
+        if submissions and not _submissions:
+            _store(submissions)
+            _synced_at = synced_at
+            _new_version(None)
+        _held = True
+
+
+def _hand_over(last):
+    """
+    remember the last change handed over to the worker holding the store
+    """
+    global _pending_written
+    if last is not None:
+        _pending_written = max(_pending_written, last)
+
+
+def load_pending():
+    """
+    add to the local store the submissions that other workers changed in the
+    snapshot; return True if there were any
+    """
+    global _pending_applied
+    submission_ids, last = snapshot.pop_pending()
+    if not submission_ids:
+        return False
+    submissions, _ = snapshot.load_submissions(submission_ids)
+    with _store_lock:
+        _store(submissions)
+        _new_version(submission_ids)
+        _pending_applied = last
+    return True
+
+
+def get_pending():
+    """
+    last change this worker handed over, and last change handed over by
+    other workers that the local store includes
+    """
+    return _pending_written, _pending_applied
+
+
+def get_synced_at():
+    """
+    time of the last successful sync with KoBo
+    """
+    return _synced_at
+
+
+def get_changes(version):
+    """
+    ids of submissions that changed after a version of the local store, or
+    None if they are not known
+    """
+    with _store_lock:
+        if version == _version:
+            return set()
+        changes = [x for v, x in _changes if v > version]
+        if len(changes) != _version - version or None in changes:
+            return None
+        return set().union(*changes)
+
+
+def get_version():
+    """
+    version of the local store, incremented at every change
+    """
+    return _version
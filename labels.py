@@ -0,0 +1,200 @@
+import logging
+import os
+import threading
+
+import openpyxl
+
+import snapshot
+
+logger = logging.getLogger(__name__)
+
+# labels shown by the app that differ from the XLSForm, or codes of other
+# versions of the form
+CASE_LABELS = {
+    "5_17": "5-17 years",
+    "skin": "Other skin condition",
+    "nicotine": "Nicotine withdrawal",
+    "chronic_diarrhoea": "Chronic diarrhoea",
+    "const": "Constipation",
+    "urti": "Acute upper respiratory tract infection / common cold",
+    "gyno": "Gynaecological disorder",
+    "pregnancy_anc": "Pregnancy ANC",
+    "pregnancy_pnc": "Pregnancy PNC",
+}
+AGE_LABELS = {"u1": "less than 1 year"}
+
+# fields whose choices are translated by case_map
+CASE_FIELDS = ["gender", "age", "is_secondary", "primary_case"]
+
+_registry = None
+_case_labels = None
+_age_labels = None
+_reported = set()
+_lock = threading.Lock()
+
+
+def get_form_path():
+    """
+    path of the XLSForm of the medical form
+    """
+    default = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "kobo-forms", "medical-form.xlsx"
+    )
+    return os.getenv("XLSFORM_PATH", default)
+
+
+def parse_form(path):
+    """
+    choice list of each select field of an XLSForm, and code -> label of
+    each choice list
+    """
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    fields, choices = {}, {}
+    rows = workbook["survey"].iter_rows(values_only=True)
+    header = next(rows)
+    for row in rows:
+        row = dict(zip(header, row))
+        if row.get("name") is None or row.get("type") is None:
+            continue
+        kind = row["type"].split()
+        fields[row["name"]] = kind[1] if kind[0] == "select_one" else None
+    rows = workbook["choices"].iter_rows(values_only=True)
+    header = next(rows)
+    for row in rows:
+        row = dict(zip(header, row))
+        if row.get("list_name") is None or row.get("name") is None:
+            continue
+        label = row.get("label")
+        choices.setdefault(row["list_name"], {})[str(row["name"])] = (
+            str(row["name"]) if label is None else str(label)
+        )
+    workbook.close()
+    return {"fields": fields, "choices": choices}
+
+
+def get_registry():
+    """
+    fields and choices of the XLSForm, parsed once and cached in the
+    snapshot until the form file changes
+    """
+    global _registry
+    with _lock:
+        if _registry is not None:
+            return _registry
+        path = get_form_path()
+        try:
+            stat = os.stat(path)
+            stamp = [os.path.abspath(path), stat.st_mtime_ns, stat.st_size]
+        except OSError as e:
+            logger.warning(f"could not read XLSForm, using cached labels: {e}")
+            stamp = None
+        cached = snapshot.load_labels()
+        if cached is not None and (stamp is None or cached["stamp"] == stamp):
+            registry = cached
+        elif stamp is not None:
+            registry = {"stamp": stamp, **parse_form(path)}
+            snapshot.save_labels(registry)
+        else:
+            registry = {"stamp": None, "fields": {}, "choices": {}}
+        _registry = registry
+        return registry
+
+
+def field_labels(field):
+    """
+    code -> label of the choices of a select field of the form
+    """
+    registry = get_registry()
+    return registry["choices"].get(registry["fields"].get(field), {})
+
+
+def case_labels():
+    """
+    code -> label used to show diagnoses, gender, age and yes/no answers
+    """
+    global _case_labels
+    if _case_labels is None:
+        labels = {}
+        for field in CASE_FIELDS:
+            labels.update(field_labels(field))
+        _case_labels = {**labels, **CASE_LABELS}
+    return _case_labels
+
+
+def age_labels():
+    """
+    code -> label used to show age
+    """
+    global _age_labels
+    if _age_labels is None:
+        _age_labels = {**field_labels("age"), **AGE_LABELS}
+    return _age_labels
+
+
+def case_map(case):
+    """
+    map KoBo XLS column names to human-readable format
+    """
+    return case_labels().get(case, case)
+
+
+def map_age(age):
+    """
+    map KoBo XLS column names to human-readable format
+    """
+    return age_labels().get(age, age)
+
+
+def translate(series, labels):
+    """
+    replace codes of a whole column by their labels; other values are kept
+    """
+    known = series.isin(list(labels.keys()))
+    return series.astype(object).where(~known, series.map(labels))
+
+
+def form_drift(df_form):
+    """
+    columns of df_form that are not in the form, and codes of select fields
+    that are not among their choices
+    """
+    registry = get_registry()
+    columns = [
+        x
+        for x in df_form.columns
+        if x not in registry["fields"].keys()
+        and not x.startswith("_")
+        and "/" not in x
+        and x != "rotation_no"
+    ]
+    codes = {}
+    for field, list_name in registry["fields"].items():
+        if list_name is None or field not in df_form.columns:
+            continue
+        values = df_form[field].dropna().unique()
+        missing = sorted(
+            str(x)
+            for x in values
+            if str(x) not in registry["choices"].get(list_name, {})
+        )
+        if missing:
+            codes[field] = missing
+    return columns, codes
+
+
+def report_drift(df_form):
+    """
+    log columns and codes of df_form missing from the form, once each
+    """
+    columns, codes = form_drift(df_form)
+    new_columns = [x for x in columns if ("column", x) not in _reported]
+    if new_columns:
+        logger.warning(f"columns not in the XLSForm: {', '.join(new_columns)}")
+    for field, missing in codes.items():
+        new_codes = [x for x in missing if ("code", field, x) not in _reported]
+        if new_codes:
+            logger.warning(
+                f"codes of {field} not in the XLSForm: {', '.join(new_codes)}"
+            )
+    _reported.update(("column", x) for x in columns)
+    _reported.update(("code", k, x) for k, v in codes.items() for x in v)
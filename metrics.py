@@ -0,0 +1,158 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets of durations, row counts and sizes
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+ROWS_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+BYTES_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+
+# name -> (type, help, histogram buckets) of the metrics, in the order they
+# are shown
+METRICS = {
+    "app_request_seconds": ("histogram", "Time to handle a request", SECONDS_BUCKETS),
+    "app_response_bytes": ("histogram", "Size of the responses", BYTES_BUCKETS),
+    "app_stage_seconds": (
+        "histogram",
+        "Time spent in each stage of a request",
+        SECONDS_BUCKETS,
+    ),
+    "app_stage_rows": ("histogram", "Rows handled by a stage", ROWS_BUCKETS),
+    "app_stage_bytes": ("histogram", "Bytes handled by a stage", BYTES_BUCKETS),
+    "app_cache_total": ("counter", "Cache hits and misses of a stage", None),
+}
+
+# metrics of this worker: (name, labels) -> value, or bucket counts, sum and
+# count of histograms
+_values = {}
+_lock = threading.Lock()
+_request = threading.local()
+
+
+def observe(name, value, **labels):
+    """
+    add a value to a histogram
+    """
+    buckets = METRICS[name][2]
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        counts, total, count = _values.get(key, ([0] * len(buckets), 0.0, 0))
+        counts = [c + (value <= b) for c, b in zip(counts, buckets)]
+        _values[key] = (counts, total + value, count + 1)
+
+
+def inc(name, value=1, **labels):
+    """
+    add to a counter
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _values[key] = _values.get(key, 0) + value
+
+
+@contextmanager
+def span(stage):
+    """
+    time a stage of a request; rows, bytes and cache ("hit" or "miss") set
+    on the yielded dict are reported with it
+    """
+    info = {}
+    started_at = time.perf_counter()
+    try:
+        yield info
+    finally:
+        record(stage, time.perf_counter() - started_at, info)
+
+
+def record(stage, duration, info=None):
+    """
+    report a stage that took duration seconds, with its rows, bytes and
+    cache result if known
+    """
+    info = info or {}
+    observe("app_stage_seconds", duration, stage=stage)
+    if "rows" in info.keys():
+        observe("app_stage_rows", info["rows"], stage=stage)
+    if "bytes" in info.keys():
+        observe("app_stage_bytes", info["bytes"], stage=stage)
+    if "cache" in info.keys():
+        inc("app_cache_total", stage=stage, result=info["cache"])
+    spans = getattr(_request, "spans", None)
+    if spans is not None:
+        spans.append((stage, duration, info))
+
+
+def start_request():
+    """
+    start collecting the spans of the request handled by this thread
+    """
+    _request.spans = []
+    _request.started_at = time.perf_counter()
+
+
+def finish_request(endpoint, size, slow_after=None):
+    """
+    report the duration and response size of the request handled by this
+    thread, and log its spans if it took longer than slow_after seconds
+    """
+    spans = getattr(_request, "spans", None)
+    if spans is None:
+        return
+    duration = time.perf_counter() - _request.started_at
+    _request.spans = None
+    observe("app_request_seconds", duration, endpoint=endpoint)
+    if size is not None:
+        observe("app_response_bytes", size, endpoint=endpoint)
+    if slow_after is not None and duration > slow_after:
+        stages = ", ".join(
+            f"{stage} {seconds:.3f}s" + "".join(f" {k}={v}" for k, v in info.items())
+            for stage, seconds, info in spans
+        )
+        logger.warning(f"slow request {endpoint} {duration:.3f}s: {stages}")
+
+
+def _labels(labels):
+    """
+    labels in the Prometheus text format
+    """
+    if not labels:
+        return ""
+    escaped = [
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    ]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def render(extra=()):
+    """
+    metrics of this worker in the Prometheus text format, followed by other
+    metrics given as (name, type, help, value)
+    """
+    with _lock:
+        values = dict(_values)
+    lines = []
+    for name, (kind, description, buckets) in METRICS.items():
+        keys = sorted(x for x in values.keys() if x[0] == name)
+        if not keys:
+            continue
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+        for key in keys:
+            labels = key[1]
+            if kind == "counter":
+                lines.append(f"{name}{_labels(labels)} {values[key]}")
+                continue
+            counts, total, count = values[key]
+            for bound, bucket_count in zip(buckets, counts):
+                bucket = _labels(labels + (("le", f"{bound:g}"),))
+                lines.append(f"{name}_bucket{bucket} {bucket_count}")
+            lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {count}')
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+    for name, kind, description, value in extra:
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
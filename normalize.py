@@ -0,0 +1,116 @@
+import pandas as pd
+
+from labels import field_labels
+from summary import LEVELS
+
+# columns of the submissions used by the app; others are dropped
+USED_COLUMNS = [
+    "_id",
+    "_submission_time",
+    "start",
+    "bracelet_number",
+    "name",
+    "gender",
+    "age",
+    *[x + y for x in LEVELS for y in ["_case", "_case_other"]],
+    "history",
+    "vital_signs",
+    "treatment",
+    "info",
+    "referral",
+    "referral_urgency",
+]
+
+# columns with coded values, stored as categoricals
+CODED_COLUMNS = [
+    "bracelet_number",
+    "gender",
+    "age",
+    *[x + "_case" for x in LEVELS],
+    "referral",
+    "referral_urgency",
+]
+
+# columns with dates, parsed once to UTC
+DATE_COLUMNS = ["start", "_submission_time"]
+
+
+def to_category(series, choices=()):
+    """
+    categorical of the values of series as text, with the choices of the
+    form and the values seen as categories, sorted like the text values
+    """
+    series = series.where(series.isna(), series.astype(str))
+    categories = sorted(set(choices) | set(series.dropna().unique()))
+    return series.astype(pd.CategoricalDtype(categories))
+
+
+def normalize_submissions(df_form):
+    """
+    keep the columns used by the app, parse dates to UTC and store coded
+    columns as categoricals
+    """
+    df_form = df_form[[x for x in USED_COLUMNS if x in df_form.columns]].copy()
+    for column in DATE_COLUMNS:
+        if column in df_form.columns:
+            df_form[column] = pd.to_datetime(
+                df_form[column], utc=True, format="ISO8601"
+            )
+    for column in CODED_COLUMNS:
+        if column in df_form.columns:
+            df_form[column] = to_category(df_form[column], field_labels(column))
+    return df_form
+
+
+def _category(column, *parts):
+    """
+    categorical dtype of a coded column holding the values of parts, like
+    to_category: the choices of the form and the values seen, so that the
+    values of removed submissions are dropped
+    """
+    values = set()
+    for part in parts:
+        if isinstance(part.dtype, pd.CategoricalDtype):
+            values |= set(part.cat.remove_unused_categories().cat.categories)
+        else:
+            values |= set(part.dropna().astype(str))
+    return pd.CategoricalDtype(sorted(set(field_labels(column)) | values))
+
+
+def replace_submissions(df_all, df_changed, submission_ids):
+    """
+    replace the rows of submission_ids in normalized df_all by normalized
+    df_changed, which holds those that still exist; rows stay ordered by
+    _id and categoricals get the categories of a full rebuild
+    """
+    df_kept = df_all[~df_all["_id"].isin(submission_ids)]
+    if df_changed.empty:
+        df_kept = df_kept.reset_index(drop=True)
+        for column in CODED_COLUMNS:
+            if column in df_kept.columns:
+                dtype = _category(column, df_kept[column])
+                df_kept[column] = df_kept[column].astype(dtype)
+        return df_kept
+    columns = list(df_kept.columns)
+    columns += [x for x in df_changed.columns if x not in columns]
+    if columns != list(df_kept.columns):
+        # columns used by the app first, in their order, like a full rebuild
+        order = {x: ix for ix, x in enumerate(USED_COLUMNS)}
+        columns = sorted(columns, key=lambda x: order.get(x, len(order)))
+        df_kept = df_kept.reindex(columns=columns)
+    df_changed = df_changed.reindex(columns=columns)
+    for column in columns:
+        kept = df_kept[column]
+        if column in CODED_COLUMNS:
+            dtype = _category(column, kept, df_changed[column])
+        elif column in DATE_COLUMNS:
+            dtype = "datetime64[ns, UTC]"
+        else:
+            continue
+        if kept.dtype != dtype:
+            df_kept = df_kept.assign(**{column: kept.astype(dtype)})
+        df_changed[column] = df_changed[column].astype(dtype)
+    df_all = pd.concat([df_kept, df_changed], ignore_index=True)
+    if not df_all["_id"].is_monotonic_increasing:
+        df_all = df_all.sort_values("_id", kind="stable", ignore_index=True)
+    return df_all
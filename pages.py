@@ -0,0 +1,102 @@
+import gzip
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from flask import Response, request
+
+import metrics
+
+# rendered pages kept by each worker, all of the latest data
+PAGE_CACHE_SIZE = int(os.getenv("PAGE_CACHE_SIZE", 64))
+
+# responses smaller than this many bytes are sent uncompressed
+GZIP_MIN_BYTES = 500
+GZIP_LEVEL = 6
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript")
+
+# (data tag, view) -> (body, gzipped body) of rendered pages, least recently
+# used first
+_pages = OrderedDict()
+_lock = threading.Lock()
+
+
+def make_etag(tag, view):
+    """
+    ETag of a view of the data tagged tag, known without rendering it
+    """
+    return hashlib.sha1(repr((tag, view)).encode()).hexdigest()[:20]
+
+
+def get_page(tag, view, render):
+    """
+    body and gzipped body of a view, rendered by render once per data tag;
+    pages of older data are dropped as soon as newer data is rendered
+    """
+    key = (tag, view)
+    with metrics.span("page_cache") as span:
+        with _lock:
+            page = _pages.get(key)
+            if page is not None:
+                _pages.move_to_end(key)
+        span["cache"] = "miss" if page is None else "hit"
+        if page is None:
+            body = render().encode()
+            page = (body, gzip.compress(body, GZIP_LEVEL))
+            with _lock:
+                for old in [x for x in _pages.keys() if x[0] != tag]:
+                    del _pages[old]
+                _pages[key] = page
+                while len(_pages) > PAGE_CACHE_SIZE:
+                    _pages.popitem(last=False)
+        span["bytes"] = len(page[0])
+    return page
+
+
+def respond(tag, view, render):
+    """
+    response with a view of the data tagged tag: 304 if the client already
+    has it, else the cached page, gzipped if the client accepts it. Without
+    a tag, the page is rendered every time
+    """
+    if tag is None:
+        return render()
+    etag = make_etag(tag, view)
+    if request.method in ("GET", "HEAD") and request.if_none_match.contains_weak(etag):
+        metrics.record("page_cache", 0, {"cache": "not_modified"})
+        response = Response(status=304)
+    else:
+        body, gzipped = get_page(tag, view, render)
+        response = Response(body, mimetype="text/html")
+        if "gzip" in request.accept_encodings:
+            response.set_data(gzipped)
+            response.headers["Content-Encoding"] = "gzip"
+    # pages may change with every refresh, so browsers check them each time
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def compress(response):
+    """
+    gzip a response of text or JSON, if the client accepts it
+    """
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or response.status_code in (204, 304)
+        or "Content-Encoding" in response.headers
+        or not (response.mimetype or "").startswith(COMPRESSIBLE_TYPES)
+        or "gzip" not in request.accept_encodings
+    ):
+        return response
+    body = response.get_data()
+    if len(body) < GZIP_MIN_BYTES:
+        return response
+    response.set_data(gzip.compress(body, GZIP_LEVEL))
+    response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
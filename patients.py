@@ -0,0 +1,103 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+# bracelet number -> row positions in the data, sorted by start
+_index = {}
+_index_version = None
+_index_keys = None
+_lock = threading.Lock()
+
+
+def _index_rows(df_form, offset=0):
+    """
+    group row positions of df_form by bracelet number, sorted by start
+    """
+    order = np.argsort(df_form["start"].to_numpy(), kind="stable")
+    groups = (
+        df_form.iloc[order]
+        .groupby("bracelet_number", sort=False, observed=True)
+        .indices
+    )
+    return {bracelet: order[ix] + offset for bracelet, ix in groups.items()}
+
+
+def _keys(df_form):
+    """
+    columns that must be unchanged to update the index incrementally
+    """
+    # categories change between versions, so compare the values
+    return df_form[["_id", "bracelet_number", "start"]].astype(
+        {"bracelet_number": object}
+    )
+
+
+def get_patient_index(df_form):
+    """
+    get the index of df_form, built once per data version and extended
+    incrementally when new submissions are appended
+    """
+    global _index, _index_version, _index_keys
+    version = df_form.attrs.get("version")
+    with _lock:
+        if version is not None and version == _index_version:
+            return _index
+        keys = _keys(df_form)
+        n = 0 if _index_keys is None else len(_index_keys)
+        if 0 < n <= len(keys) and keys.iloc[:n].equals(_index_keys):
+            # only new rows: merge their positions into the existing index
+            index = dict(_index)
+            starts = df_form["start"].to_numpy()
+            for bracelet, positions in _index_rows(df_form.iloc[n:], n).items():
+                if bracelet in index:
+                    positions = np.concatenate([index[bracelet], positions])
+                    positions = positions[np.argsort(starts[positions], kind="stable")]
+                index[bracelet] = positions
+        else:
+            index = _index_rows(df_form)
+        _index, _index_version, _index_keys = index, version, keys
+        return index
+
+
+def _plain(df):
+    """
+    columns backed by shared Arrow data have NA for missing values; give
+    them plain columns with NaN instead
+    """
+    arrow_columns = [
+        x for x, dtype in df.dtypes.items() if isinstance(dtype, pd.ArrowDtype)
+    ]
+    if arrow_columns:
+        df = df.assign(
+            **{x: df[x].to_numpy(dtype=object, na_value=np.nan) for x in arrow_columns}
+        )
+    return df
+
+
+def get_patient(df_form, bracelet_number):
+    """
+    get consultations of a patient, sorted by start
+    """
+    if "bracelet_number" not in df_form.columns:
+        return df_form.iloc[0:0]
+    positions = get_patient_index(df_form).get(bracelet_number, [])
+    # a patient has few rows, so they are cheap to convert
+    return _plain(df_form.iloc[positions])
+
+
+def get_patients(df_form, bracelet_numbers=None):
+    """
+    get consultations of several patients, or of all patients, grouped by
+    patient in the order given (of first consultation for all patients) and
+    sorted by start
+    """
+    if "bracelet_number" not in df_form.columns:
+        return df_form.iloc[0:0]
+    index = get_patient_index(df_form)
+    if bracelet_numbers is None:
+        bracelet_numbers = index.keys()
+    positions = [index[x] for x in dict.fromkeys(bracelet_numbers) if x in index]
+    if not positions:
+        return df_form.iloc[0:0]
+    return _plain(df_form.iloc[np.concatenate(positions)])
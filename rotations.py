@@ -0,0 +1,152 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import httplib2
+from googleapiclient.discovery import build
+from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp
+
+import metrics
+import snapshot
+
+logger = logging.getLogger(__name__)
+
+SCOPES = ["https://www.googleapis.com/auth/spreadsheets.readonly"]
+RANGE_NAME = "Rotations!A:C"
+
+_service = None
+_rotations = None
+_fetched_at = 0.0
+_lock = threading.Lock()
+
+
+def get_service():
+    """
+    get the Google Sheets client, built once per process
+    """
+    global _service
+    if _service is None:
+        sa_file = json.loads(os.getenv("GOOGLESERVICEACCUNT"))
+        creds = service_account.Credentials.from_service_account_info(
+            sa_file, scopes=SCOPES
+        )
+        timeout = float(os.getenv("SHEETS_TIMEOUT", 30))
+        http = AuthorizedHttp(creds, http=httplib2.Http(timeout=timeout))
+        # another server than Google's, e.g. a local stand-in for benchmarks
+        client_options = None
+        if os.getenv("SHEETS_URL"):
+            client_options = {"api_endpoint": os.getenv("SHEETS_URL")}
+        _service = build("sheets", "v4", http=http, client_options=client_options)
+    return _service
+
+
+def fetch_rotations():
+    """
+    get rotation table from Google Sheets
+    """
+    with metrics.span("sheets_fetch") as span:
+        sheet = get_service().spreadsheets()
+        result = (
+            sheet.values()
+            .get(spreadsheetId=os.getenv("GOOGLESHEETID"), range=RANGE_NAME)
+            .execute()
+        )
+        values = result.get("values", [])
+        span["rows"] = len(values)
+    snapshot.save_rotations(values)
+    return parse_rotations(values)
+
+
+def parse_rotations(values):
+    """
+    convert values of the rotation sheet to a table
+    """
+    df = pd.DataFrame.from_records(values[1:], columns=values[0])
+    df["Start date"] = pd.to_datetime(df["Start date"], dayfirst=True)
+    df["End date"] = pd.to_datetime(df["End date"], dayfirst=True)
+    df["Rotation No"] = df["Rotation No"].astype(float).round(0).astype(int)
+    return df
+
+
+def rotation_windows(df):
+    """
+    rotation numbers with the start and end of each rotation in UTC, sorted
+    by start
+    """
+    df = df.sort_values("Start date", kind="stable")
+    return (
+        df["Rotation No"].to_numpy(),
+        pd.to_datetime(df["Start date"], utc=True),
+        pd.to_datetime(df["End date"], utc=True),
+    )
+
+
+def assign_rotations(starts, df):
+    """
+    rotation of each start time, found by an interval lookup in the rotation
+    table: the latest rotation starting at or before it, if it has not ended
+    """
+    numbers, begins, ends = rotation_windows(df)
+    values = starts.to_numpy(dtype="datetime64[ns]")
+    ix = np.searchsorted(begins.to_numpy(dtype="datetime64[ns]"), values, "right") - 1
+    found = ix >= 0
+    ix = ix.clip(0)
+    found &= values <= ends.to_numpy(dtype="datetime64[ns]")[ix]
+    return pd.Series(
+        pd.arrays.IntegerArray(numbers[ix].astype("int64"), mask=~found),
+        index=starts.index,
+    )
+
+
+def get_rotations(fetch=True):
+    """
+    get rotation table, read again from Google Sheets only when older than
+    ROTATIONS_TTL seconds; if that fails, keep using the last table that was
+    read. With fetch=False, the last table is used regardless of its age
+    """
+    global _rotations, _fetched_at
+    ttl = float(os.getenv("ROTATIONS_TTL", 600))
+    with _lock:
+        if _rotations is None or (fetch and time.time() - _fetched_at > ttl):
+            try:
+                _rotations = fetch_rotations()
+                _fetched_at = time.time()
+            except Exception as e:
+                if _rotations is None:
+                    raise
+                _fetched_at = time.time()
+                logger.warning(f"could not read rotations, using cached table: {e}")
+        return _rotations
+
+
+def get_last_rotations():
+    """
+    get the last rotation table that was read, without waiting for a read
+    in progress
+    """
+    return _rotations
+
+
+def load_snapshot():
+    """
+    use the rotation table saved on disk until Google Sheets is read
+    """
+    global _rotations
+    values = snapshot.load_rotations()
+    with _lock:
+        if values and _rotations is None:
+            _rotations = parse_rotations(values)
+
+
+def invalidate_rotations():
+    """
+    force the rotation table to be read again at the next request
+    """
+    global _fetched_at
+    with _lock:
+        _fetched_at = 0.0
@@ -0,0 +1,128 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from labels import case_labels, translate
+from summary import LEVELS
+
+# number of patients returned by a search, by default
+SEARCH_LIMIT = 10
+
+# end of the range of strings starting with a prefix
+_LAST_CHARACTER = "\U0010ffff"
+
+_index = None
+_index_version = None
+_lock = threading.Lock()
+
+
+def tokens(series):
+    """
+    lowercase words of each value of a text column
+    """
+    return series.astype(object).dropna().astype(str).str.lower().str.findall(r"\w+")
+
+
+def _prefix_range(values, prefix):
+    """
+    positions of the values starting with prefix in a sorted array
+    """
+    start = np.searchsorted(values, prefix, "left")
+    end = np.searchsorted(values, prefix + _LAST_CHARACTER, "right")
+    return start, end
+
+
+def build_index(df_form):
+    """
+    sorted bracelet numbers, sorted words of names and diagnoses with their
+    bracelet numbers, and name and last consultation of each patient
+    """
+    df = df_form[df_form["bracelet_number"].notna()]
+    bracelets = df["bracelet_number"].astype(object).astype(str)
+
+    texts = [df[x] for x in ["name"] if x in df.columns]
+    for level in LEVELS:
+        if level + "_case" in df.columns:
+            texts.append(translate(df[level + "_case"], case_labels()))
+        if level + "_case_other" in df.columns:
+            texts.append(df[level + "_case_other"])
+    # texts repeat a lot, so each distinct text is split into words once
+    pairs = pd.concat(
+        [pd.DataFrame({"bracelet": bracelets, "text": x.astype(object)}) for x in texts]
+        + [pd.DataFrame({"bracelet": [], "text": []})]
+    )
+    pairs = pairs.dropna().drop_duplicates()
+    texts = pairs["text"].unique()
+    words = pairs["text"].map(dict(zip(texts, tokens(pd.Series(texts)))))
+    words = (
+        pd.DataFrame({"word": words, "bracelet": pairs["bracelet"]})
+        .explode("word")
+        .dropna()
+        .drop_duplicates()
+        .sort_values(["word", "bracelet"])
+    )
+
+    patients = pd.DataFrame({"bracelet": bracelets, "start": df["start"]})
+    if "name" in df.columns:
+        patients["name"] = df["name"].astype(object)
+    else:
+        patients["name"] = None
+    patients = patients.sort_values("start", kind="stable").groupby("bracelet")
+    patients = pd.DataFrame(
+        {
+            "name": patients["name"].last(),
+            "last_seen": patients["start"].last(),
+        }
+    )
+    return {
+        "bracelets": np.array(sorted(patients.index), dtype=str),
+        "words": words["word"].to_numpy(dtype=str),
+        "word_bracelets": words["bracelet"].to_numpy(dtype=str),
+        "patients": patients,
+    }
+
+
+def get_index(df_form):
+    """
+    get the search index of df_form, built once per data version
+    """
+    global _index, _index_version
+    version = df_form.attrs.get("version")
+    with _lock:
+        if _index is None or version is None or version != _index_version:
+            _index, _index_version = build_index(df_form), version
+        return _index
+
+
+def search_patients(df_form, query, limit=SEARCH_LIMIT):
+    """
+    patients whose bracelet number starts with query, then those with a
+    word of their name or diagnoses starting with each word of query
+    """
+    query = query.strip()
+    if not query or "bracelet_number" not in df_form.columns:
+        return []
+    index = get_index(df_form)
+
+    start, end = _prefix_range(index["bracelets"], query)
+    found = list(index["bracelets"][start : min(end, start + limit)])
+    matches = None
+    for word in query.lower().split():
+        start, end = _prefix_range(index["words"], word)
+        bracelets = set(index["word_bracelets"][start:end])
+        matches = bracelets if matches is None else matches & bracelets
+    found += sorted((matches or set()) - set(found))
+    found = found[:limit]
+
+    patients = index["patients"].loc[found]
+    return [
+        {
+            "bracelet_number": bracelet,
+            "name": None if pd.isna(name) else name,
+            "last_seen": None if pd.isna(last_seen) else last_seen.date().isoformat(),
+        }
+        for bracelet, name, last_seen in zip(
+            patients.index, patients["name"], patients["last_seen"]
+        )
+    ]
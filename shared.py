@@ -0,0 +1,200 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+import pyarrow as pa
+
+logger = logging.getLogger(__name__)
+
+# seconds between checks for newly published data
+POLL_INTERVAL = 1.0
+
+# lock held by the worker that syncs with KoBo, for its whole life
+_leader_file = None
+_leader_pid = None
+_lead_tried_at = 0.0
+_published = (None, None)
+_lock = threading.Lock()
+
+
+def get_dir():
+    """
+    directory where data is published for all workers, or None if data is
+    not shared
+    """
+    return os.getenv("SHARED_DATA_DIR") or None
+
+
+def enabled():
+    """
+    whether workers share the data published by a single worker
+    """
+    return get_dir() is not None
+
+
+def lead():
+    """
+    try to become the worker that syncs with KoBo and publishes the data;
+    return True if this worker is (or just became) that worker
+    """
+    global _leader_file, _leader_pid, _lead_tried_at
+    with _lock:
+        # a lock inherited from the parent process does not count
+        if _leader_file is not None and _leader_pid == os.getpid():
+            return True
+        if time.time() - _lead_tried_at < POLL_INTERVAL:
+            return False
+        _lead_tried_at = time.time()
+        os.makedirs(get_dir(), exist_ok=True)
+        file = open(os.path.join(get_dir(), "leader.lock"), "a")
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file.close()
+            return False
+        _leader_file, _leader_pid = file, os.getpid()
+        logger.info(f"worker {os.getpid()} syncs and publishes the data")
+        return True
+
+
+def _write(path, write):
+    """
+    write a file next to path, then move it into place in one step
+    """
+    temporary = f"{path}.{os.getpid()}.tmp"
+    write(temporary)
+    os.replace(temporary, path)
+
+
+def to_arrow(df_form):
+    """
+    convert df_form to an Arrow table; columns mixing types are stored as
+    text
+    """
+    df_form = df_form.copy(deep=False)
+    df_form.attrs = {}
+    try:
+        return pa.Table.from_pandas(df_form, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        for column in df_form.select_dtypes(object).columns:
+            values = df_form[column]
+            df_form[column] = values.where(values.isna(), values.astype(str))
+        return pa.Table.from_pandas(df_form, preserve_index=False)
+
+
+def _write_meta(meta):
+    """
+    write the description of the published data
+    """
+
+    def write(path):
+        with open(path, "w") as file:
+            json.dump(meta, file)
+
+    _write(os.path.join(get_dir(), "generation.json"), write)
+
+
+def publish(df_form, rotation_no, summary, synced_at, pending):
+    """
+    publish a new generation of the data as an Arrow IPC file, with the
+    rotation number, summary of morbidities, time of the last sync, last
+    change handed over by other workers that it includes and tag of the
+    pages rendered from it
+    """
+    published = get_published()
+    generation = 1 if published is None else published["generation"] + 1
+    data_file = f"data-{generation}.arrow"
+    tag = df_form.attrs.get("tag")
+    table = to_arrow(df_form)
+
+    def write_table(path):
+        with pa.OSFile(path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+    _write(os.path.join(get_dir(), data_file), write_table)
+    _write_meta(
+        {
+            "generation": generation,
+            "file": data_file,
+            "rotation_no": None if rotation_no is None else int(rotation_no),
+            "summary": summary,
+            "synced_at": synced_at,
+            "pending": pending,
+            "tag": tag,
+        }
+    )
+
+    # workers still reading an older file keep it until they let go of it
+    for name in os.listdir(get_dir()):
+        if name.startswith("data-") and name.endswith(".arrow"):
+            if int(name[5:-6]) < generation - 1:
+                os.remove(os.path.join(get_dir(), name))
+    return generation
+
+
+def update_synced_at(synced_at):
+    """
+    publish the time of a sync that did not change the data
+    """
+    published = get_published()
+    if published is not None and published["synced_at"] != synced_at:
+        _write_meta({**published, "synced_at": synced_at})
+
+
+def get_published():
+    """
+    description of the latest published data, read again only when the
+    file changed; None if nothing was published yet
+    """
+    global _published
+    path = os.path.join(get_dir(), "generation.json")
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    if _published[0] != key:
+        with open(path) as file:
+            _published = (key, json.load(file, object_pairs_hook=OrderedDict))
+    return _published[1]
+
+
+def wait_for(pending, timeout):
+    """
+    wait until published data includes the changes handed over up to
+    pending; return the latest description, or None if nothing was
+    published yet
+    """
+    deadline = time.time() + timeout
+    published = get_published()
+    while time.time() < deadline and (
+        published is None or published["pending"] < pending
+    ):
+        time.sleep(min(POLL_INTERVAL / 10, max(0, deadline - time.time())))
+        published = get_published()
+    return published
+
+
+def load(published):
+    """
+    memory-map published data: columns are backed by the file, which all
+    workers share through the page cache instead of holding a copy each
+    """
+    source = pa.memory_map(os.path.join(get_dir(), published["file"]))
+    table = pa.ipc.open_file(source).read_all()
+    # coded columns become categoricals, whose codes are small to copy
+    df_form = table.to_pandas(
+        types_mapper=lambda x: None if pa.types.is_dictionary(x) else pd.ArrowDtype(x)
+    )
+    df_form.attrs["version"] = ("shared", published["generation"])
+    df_form.attrs["tag"] = published.get("tag")
+    summary = published["summary"]
+    if summary is not None:
+        summary = tuple(summary)
+    return df_form, published["rotation_no"], summary
@@ -0,0 +1,79 @@
+import threading
+
+
+class _Call:
+    """
+    a call in progress and, once done, its result or error
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Group:
+    """
+    run a function once for concurrent callers with the same key: callers
+    that arrive while it runs wait for it and share its result
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.flights = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """
+        call fn, or wait for the call of fn with the same key in progress
+        """
+        with self._lock:
+            self.calls += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.flights += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def forget(self, key):
+        """
+        let the next caller start a new call instead of waiting for the one
+        in progress, e.g. because it started before a change
+        """
+        with self._lock:
+            self._calls.pop(key, None)
+
+    def stats(self):
+        """
+        number of calls, of calls that ran fn and of calls that shared a
+        result
+        """
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "flights": self.flights,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._calls),
+            }
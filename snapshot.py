@@ -0,0 +1,270 @@
+import json
+import logging
+import os
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+# increment when the tables below change; older snapshots are discarded
+SCHEMA_VERSION = 1
+
+
+def connect():
+    """
+    open the snapshot database, (re)creating it if the schema is outdated
+    """
+    path = os.getenv("SNAPSHOT_PATH", "snapshot.sqlite3")
+    connection = sqlite3.connect(path, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+    )
+    # submissions changed by a worker that does not hold the data
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS pending "
+        "(seq INTEGER PRIMARY KEY AUTOINCREMENT, id INTEGER)"
+    )
+    # summary of each rotation; value is a count, or text for bracelets
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS cube (rotation_no INTEGER, measure TEXT, "
+        "key TEXT, label TEXT, value, position INTEGER)"
+    )
+    connection.execute("CREATE INDEX IF NOT EXISTS cube_rotation ON cube (rotation_no)")
+    row = connection.execute(
+        "SELECT value FROM meta WHERE key = 'schema_version'"
+    ).fetchone()
+    if row is None or int(row[0]) != SCHEMA_VERSION:
+        with connection:
+            connection.execute("DROP TABLE IF EXISTS submissions")
+            connection.execute("DELETE FROM meta")
+            connection.execute(
+                "CREATE TABLE submissions (id INTEGER PRIMARY KEY, data TEXT)"
+            )
+            connection.execute(
+                "INSERT INTO meta VALUES ('schema_version', ?)", (str(SCHEMA_VERSION),)
+            )
+    return connection
+
+
+def _mark_pending(connection, submission_ids):
+    """
+    mark submissions for the worker holding the data; return the number of
+    the last mark
+    """
+    connection.executemany(
+        "INSERT INTO pending (id) VALUES (?)", [(x,) for x in submission_ids]
+    )
+    return connection.execute("SELECT MAX(seq) FROM pending").fetchone()[0]
+
+
+def save_submissions(
+    submissions, deleted=(), replace=False, synced_at=None, pending=False
+):
+    """
+    write new or edited submissions to the snapshot and remove deleted ones;
+    with pending=True, they are also marked for the worker holding the data
+    and the number of the last mark is returned
+    """
+    last = None
+    try:
+        connection = connect()
+        with connection:
+            if replace:
+                connection.execute("DELETE FROM submissions")
+            connection.executemany(
+                "INSERT OR REPLACE INTO submissions VALUES (?, ?)",
+                [(x["_id"], json.dumps(x)) for x in submissions],
+            )
+            if pending:
+                last = _mark_pending(connection, [x["_id"] for x in submissions])
+            connection.executemany(
+                "DELETE FROM submissions WHERE id = ?", [(x,) for x in deleted]
+            )
+            if synced_at is not None:
+                connection.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('synced_at', ?)",
+                    (str(synced_at),),
+                )
+        connection.close()
+    except sqlite3.Error as e:
+        logger.warning(f"could not save submissions to snapshot: {e}")
+    return last
+
+
+def update_submissions(submission_ids, data):
+    """
+    update fields of submissions in the snapshot and mark them for the
+    worker holding the data; return the number of the last mark
+    """
+    last = None
+    try:
+        connection = connect()
+        with connection:
+            updated = []
+            for submission_id in submission_ids:
+                row = connection.execute(
+                    "SELECT data FROM submissions WHERE id = ?", (int(submission_id),)
+                ).fetchone()
+                if row is not None:
+                    updated.append({**json.loads(row[0]), **data})
+            connection.executemany(
+                "INSERT OR REPLACE INTO submissions VALUES (?, ?)",
+                [(x["_id"], json.dumps(x)) for x in updated],
+            )
+            last = _mark_pending(connection, [x["_id"] for x in updated])
+        connection.close()
+    except sqlite3.Error as e:
+        logger.warning(f"could not update submissions in snapshot: {e}")
+    return last
+
+
+def pop_pending():
+    """
+    get and forget the ids of submissions marked for the worker holding the
+    data, and the number of the last mark (None if there are none)
+    """
+    try:
+        connection = connect()
+        with connection:
+            rows = connection.execute("SELECT seq, id FROM pending").fetchall()
+            if rows:
+                last = max(x[0] for x in rows)
+                connection.execute("DELETE FROM pending WHERE seq <= ?", (last,))
+        connection.close()
+    except sqlite3.Error as e:
+        logger.warning(f"could not read pending submissions from snapshot: {e}")
+        return [], None
+    if not rows:
+        return [], None
+    return sorted({x[1] for x in rows}), last
+
+
+def load_submissions(submission_ids=None):
+    """
+    get submissions (all, or only those with the given ids) and time of the
+    last sync from the snapshot
+    """
+    try:
+        connection = connect()
+        if submission_ids is None:
+            rows = connection.execute("SELECT data FROM submissions ORDER BY id")
+        else:
+            rows = [
+                x
+                for submission_id in sorted(submission_ids)
+                for x in connection.execute(
+                    "SELECT data FROM submissions WHERE id = ?", (submission_id,)
+                )
+            ]
+        submissions = [json.loads(x[0]) for x in rows]
+        row = connection.execute(
+            "SELECT value FROM meta WHERE key = 'synced_at'"
+        ).fetchone()
+        connection.close()
+    except sqlite3.Error as e:
+        logger.warning(f"could not load submissions from snapshot: {e}")
+        return [], None
+    return submissions, None if row is None else float(row[0])
+
+
+def save_rotations(values):
+    """
+    write the raw values of the rotation sheet to the snapshot
+    """
+    try:
+        connection = connect()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('rotations', ?)",
+                (json.dumps(values),),
+            )
+        connection.close()
+    except sqlite3.Error as e:
+        logger.warning(f"could not save rotations to snapshot: {e}")
+
+
+def load_rotations():
+    """
+    get the raw values of the rotation sheet from the snapshot
+    """
+    try:
+        connection = connect()
+        row = connection.execute(
+            "SELECT value FROM meta WHERE key = 'rotations'"
+        ).fetchone()
+        connection.close()
+    except sqlite3.Error as e:
+        logger.warning(f"could not load rotations from snapshot: {e}")
+        return None
+    return None if row is None else json.loads(row[0])
+
+
+def save_labels(registry):
+    """
+    write the fields and choices parsed from the XLSForm to the snapshot
+    """
+    try:
+        connection = connect()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('labels', ?)",
+                (json.dumps(registry),),
+            )
+        connection.close()
+    except sqlite3.Error as e:
+        logger.warning(f"could not save labels to snapshot: {e}")
+
+
+def load_labels():
+    """
+    get the fields and choices parsed from the XLSForm from the snapshot
+    """
+    try:
+        connection = connect()
+        row = connection.execute(
+            "SELECT value FROM meta WHERE key = 'labels'"
+        ).fetchone()
+        connection.close()
+    except sqlite3.Error as e:
+        logger.warning(f"could not load labels from snapshot: {e}")
+        return None
+    return None if row is None else json.loads(row[0])
+
+
+def save_cube(rows, rotation_nos, replace=False):
+    """
+    replace the rows of the summary cube of some rotations, or of all of
+    them with replace=True
+    """
+    try:
+        connection = connect()
+        with connection:
+            if replace:
+                connection.execute("DELETE FROM cube")
+            connection.executemany(
+                "DELETE FROM cube WHERE rotation_no = ?", [(x,) for x in rotation_nos]
+            )
+            connection.executemany("INSERT INTO cube VALUES (?, ?, ?, ?, ?, ?)", rows)
+        connection.close()
+    except sqlite3.Error as e:
+        logger.warning(f"could not save summary cube to snapshot: {e}")
+
+
+def load_cube(rotation_no=None):
+    """
+    get the rows of the summary cube, of one rotation or of all of them
+    """
+    try:
+        connection = connect()
+        query = "SELECT * FROM cube"
+        if rotation_no is None:
+            rows = connection.execute(query).fetchall()
+        else:
+            rows = connection.execute(
+                query + " WHERE rotation_no = ?", (rotation_no,)
+            ).fetchall()
+        connection.close()
+    except sqlite3.Error as e:
+        logger.warning(f"could not load summary cube from snapshot: {e}")
+        return []
+    return rows
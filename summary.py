@@ -0,0 +1,344 @@
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from labels import case_labels, case_map, translate
+
+LEVELS = ["primary", "secondary", "tertiary"]
+LABELS = ["male", "female", "u5", "total"]
+
+
+def demographic_label(df, default):
+    """
+    label used to count a patient: u5, male, female or default
+    """
+    return np.select(
+        [
+            df["age"].isin(["u1", "1_4"]).to_numpy(dtype=bool, na_value=False),
+            (df["gender"] == "male").to_numpy(dtype=bool, na_value=False),
+            (df["gender"] == "female").to_numpy(dtype=bool, na_value=False),
+        ],
+        ["u5", "male", "female"],
+        default,
+    )
+
+
+def melt_cases(df, replace_other):
+    """
+    one row per diagnosis (patient, row, level, case, label) of df
+    """
+    case_columns = [x + "_case" for x in LEVELS if x + "_case" in df.columns]
+    df_cases = df[case_columns + ["patient", "rank", "label"]].melt(
+        id_vars=["patient", "rank", "label"],
+        value_vars=case_columns,
+        var_name="level",
+        value_name="case",
+        ignore_index=False,
+    )
+    df_cases["row"] = df_cases.index
+    other_columns = {
+        x + "_case": x + "_case_other"
+        for x in LEVELS
+        if x + "_case_other" in df.columns
+    }
+    df_cases["level"] = df_cases["level"].map(
+        {x: ix for ix, x in enumerate(case_columns)}
+    )
+    if replace_other and other_columns:
+        # diagnoses labelled "Other" are replaced by the specified diagnosis
+        df_other = (
+            df[list(other_columns.values())]
+            .rename(columns={v: k for k, v in other_columns.items()})
+            .melt(
+                value_vars=list(other_columns.keys()),
+                var_name="level",
+                value_name="other",
+                ignore_index=False,
+            )
+        )
+        df_other["level"] = df_other["level"].map(
+            {x: ix for ix, x in enumerate(case_columns)}
+        )
+        df_other["row"] = df_other.index
+        df_cases = df_cases.merge(df_other, on=["row", "level"], how="left")
+    df_cases = df_cases[df_cases["case"].notna()]
+    df_cases["case"] = translate(df_cases["case"], case_labels())
+    if "other" in df_cases.columns:
+        is_other = (df_cases["case"] == "Other") & df_cases["other"].notna()
+        df_cases["case"] = df_cases["case"].where(~is_other, df_cases["other"])
+    return df_cases.sort_values(["rank", "row", "level"], kind="stable")
+
+
+def aggregate_summary(df_form):
+    """
+    count morbidities, patients and referrals of df_form
+    """
+    consultations = len(df_form)
+    if "bracelet_number" not in df_form.columns:
+        return 0, 0, OrderedDict(), {}
+
+    # patients with a bracelet number, in order of first consultation
+    df = df_form[df_form["bracelet_number"].notna()].reset_index(drop=True)
+    df["patient"] = df["bracelet_number"].astype(object)
+    df["rank"] = pd.factorize(df["bracelet_number"])[0]
+    df["label"] = demographic_label(df, "")
+
+    # patients without bracelet number, one per age and gender
+    df_no_bracelet = (
+        df_form[pd.isna(df_form["bracelet_number"])]
+        .groupby(["age", "gender"], observed=True)
+        .last()
+        .reset_index()
+    )
+    df_no_bracelet["patient"] = "NaN"
+    with_bracelet = df["patient"].nunique()
+    df_no_bracelet["rank"] = np.arange(len(df_no_bracelet)) + with_bracelet
+    df_no_bracelet["label"] = demographic_label(df_no_bracelet, "other")
+    patients = with_bracelet + len(df_no_bracelet)
+
+    df_cases = pd.concat(
+        [melt_cases(df, True), melt_cases(df_no_bracelet, False)],
+        ignore_index=True,
+    )
+
+    # morbidities: each patient is counted once, with its latest label
+    case_order = df_cases.drop_duplicates("case")["case"].tolist()
+    df_cases = df_cases.drop_duplicates(["rank", "case"], keep="last")
+    counts = pd.crosstab(df_cases["case"], df_cases["label"])
+    counts = counts.reindex(columns=LABELS, fill_value=0)
+    counts["total"] = df_cases.groupby("case").size()
+    bracelets = df_cases.groupby("case", sort=False)["patient"].agg(", ".join)
+    first_rank = df_cases.groupby("case", sort=False)["rank"].first()
+
+    morbidities = OrderedDict()
+    totals = counts.loc[case_order, "total"]
+    for case in totals.sort_values(ascending=False, kind="stable").index:
+        morbidities[case] = {x: int(counts.at[case, x]) for x in LABELS}
+        if first_rank[case] < with_bracelet:
+            morbidities[case]["bracelet"] = bracelets[case]
+
+    # referrals: each patient is counted once per referral type
+    referral_columns = [
+        x for x in ["rank", "referral", "referral_urgency"] if x in df.columns
+    ]
+    df_referrals = pd.concat(
+        [x[referral_columns] for x in [df, df_no_bracelet] if not x.empty]
+        or [df[referral_columns]],
+        ignore_index=True,
+    )
+    df_referrals = df_referrals[df_referrals["referral"] == "yes"]
+    df_referrals = df_referrals.sort_values("rank", kind="stable")
+    referrals = {}
+    if not df_referrals.empty:
+        referrals["Referrals needed"] = df_referrals["rank"].nunique()
+        df_urgency = df_referrals[df_referrals["referral_urgency"].notna()]
+        urgency = (
+            df_urgency["referral_urgency"]
+            .astype(str)
+            .str.replace("_", " ")
+            .str.capitalize()
+        )
+        df_urgency = pd.DataFrame({"rank": df_urgency["rank"], "urgency": urgency})
+        for key, count in (
+            df_urgency.drop_duplicates().groupby("urgency", sort=False).size().items()
+        ):
+            referrals[key] = int(count)
+
+    return consultations, patients, morbidities, referrals
+
+
+# fields of a submission used by the summary
+SUMMARY_FIELDS = [
+    "_id",
+    "bracelet_number",
+    "age",
+    "gender",
+    "referral",
+    "referral_urgency",
+] + [x + y for x in LEVELS for y in ["_case", "_case_other"]]
+
+
+def _label(row, default):
+    """
+    label used to count a patient: u5, male, female or default
+    """
+    if row.get("age") in ["u1", "1_4"]:
+        return "u5"
+    if row.get("gender") in ["male", "female"]:
+        return row["gender"]
+    return default
+
+
+def _contribution(rows, replace_other, default_label):
+    """
+    morbidities (with latest label) and referrals of a patient
+    """
+    cases, referrals = {}, {}
+    for row in rows:
+        for level in LEVELS:
+            case = row.get(level + "_case")
+            if case is None:
+                continue
+            case = case_map(case)
+            other = row.get(level + "_case_other")
+            if replace_other and case == "Other" and other is not None:
+                case = other
+            cases[case] = _label(row, default_label)
+        if row.get("referral") == "yes":
+            referrals["Referrals needed"] = 1
+            urgency = row.get("referral_urgency")
+            if urgency is not None:
+                referrals[str(urgency).replace("_", " ").capitalize()] = 1
+    return cases, list(referrals.keys())
+
+
+class SummaryState:
+    """
+    morbidity summary that is updated one submission at a time; only the
+    patients of changed submissions are counted again
+    """
+
+    def __init__(self, version=None):
+        self.version = version
+        self.rows = {}
+        self.patients = {}
+        self.contributions = {}
+        self.counts = {}
+        self.referrals = {}
+
+    @classmethod
+    def from_data(cls, df_form):
+        """
+        build the summary of df_form from scratch
+        """
+        state = cls(df_form.attrs.get("version"))
+        state.upsert(df_form)
+        return state
+
+    @staticmethod
+    def _patient(row):
+        """
+        bracelet number, or age and gender of patients without bracelet
+        """
+        if row.get("bracelet_number") is not None:
+            return ("bracelet", row["bracelet_number"])
+        if row.get("age") is not None and row.get("gender") is not None:
+            return ("no bracelet", row["age"], row["gender"])
+        return None
+
+    def upsert(self, df):
+        """
+        add or replace the submissions in df
+        """
+        columns = [x for x in SUMMARY_FIELDS if x in df.columns]
+        df = df[columns].astype(object)
+        records = df.where(df.notna(), None).to_dict("records")
+        changed = set()
+        for row in records:
+            changed.add(self._remove_row(row["_id"]))
+            self.rows[row["_id"]] = row
+            patient = self._patient(row)
+            if patient is not None:
+                self.patients.setdefault(patient, {})[row["_id"]] = row
+            changed.add(patient)
+        self._count(changed)
+
+    def remove(self, submission_ids):
+        """
+        remove submissions by _id
+        """
+        self._count({self._remove_row(x) for x in submission_ids})
+
+    def _remove_row(self, submission_id):
+        row = self.rows.pop(submission_id, None)
+        if row is None:
+            return None
+        patient = self._patient(row)
+        if patient is not None:
+            del self.patients[patient][submission_id]
+        return patient
+
+    def _count(self, patients):
+        """
+        count again the morbidities and referrals of patients
+        """
+        for patient in patients:
+            if patient is None:
+                continue
+            old_cases, old_referrals = self.contributions.pop(patient, ({}, []))
+            for case, label in old_cases.items():
+                counts = self.counts[case]
+                counts[label] = counts.get(label, 0) - 1
+                counts["total"] -= 1
+                if counts["total"] == 0:
+                    del self.counts[case]
+            for key in old_referrals:
+                self.referrals[key] -= 1
+                if self.referrals[key] == 0:
+                    del self.referrals[key]
+
+            rows = self.patients.get(patient, {})
+            if not rows:
+                self.patients.pop(patient, None)
+                continue
+            rows = [rows[x] for x in sorted(rows.keys())]
+            if patient[0] == "bracelet":
+                cases, referrals = _contribution(rows, True, "")
+            else:
+                # like groupby().last(): last value of each field
+                last = {}
+                for row in rows:
+                    last.update({k: v for k, v in row.items() if v is not None})
+                cases, referrals = _contribution([last], False, "other")
+            self.contributions[patient] = (cases, referrals)
+            for case, label in cases.items():
+                counts = self.counts.setdefault(case, {"total": 0})
+                counts[label] = counts.get(label, 0) + 1
+                counts["total"] += 1
+            for key in referrals:
+                self.referrals[key] = self.referrals.get(key, 0) + 1
+
+    def summary(self):
+        """
+        consultations, patients, morbidities and referrals, like
+        aggregate_summary
+        """
+        # patients with bracelet in order of first consultation, then others
+        with_bracelet = sorted(
+            (min(rows.keys()), patient)
+            for patient, rows in self.patients.items()
+            if patient[0] == "bracelet"
+        )
+        ranks = {patient: ix for ix, (_, patient) in enumerate(with_bracelet)}
+        for patient in sorted(x for x in self.patients.keys() if x[0] != "bracelet"):
+            ranks[patient] = len(ranks)
+
+        order, bracelets = {}, {}
+        for patient, rank in sorted(ranks.items(), key=lambda x: x[1]):
+            cases = self.contributions[patient][0]
+            for ix, case in enumerate(cases.keys()):
+                order.setdefault(case, (rank, ix))
+                bracelets.setdefault(case, []).append(
+                    patient[1] if patient[0] == "bracelet" else "NaN"
+                )
+
+        morbidities = OrderedDict()
+        for case in sorted(
+            self.counts.keys(), key=lambda x: (-self.counts[x]["total"], order[x])
+        ):
+            morbidities[case] = {x: self.counts[case].get(x, 0) for x in LABELS}
+            if order[case][0] < len(with_bracelet):
+                morbidities[case]["bracelet"] = ", ".join(bracelets[case])
+
+        referrals = {}
+        first_referral = {}
+        for patient, rank in ranks.items():
+            for ix, key in enumerate(self.contributions[patient][1]):
+                first_referral[key] = min(
+                    first_referral.get(key, (rank, ix)), (rank, ix)
+                )
+        for key in sorted(self.referrals.keys(), key=lambda x: first_referral[x]):
+            referrals[key] = self.referrals[key]
+
+        return len(self.rows), len(self.patients), morbidities, referrals
@@ -0,0 +1,88 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from benchmarks import standins, synthetic  # noqa: E402
+
+# submissions served by the KoBo stand-in at the start of each test
+SUBMISSIONS = 300
+
+
+@pytest.fixture(autouse=True, scope="session")
+def snapshot_path(tmp_path_factory):
+    """
+    keep the labels parsed from the XLSForm out of the snapshot of the repo
+    """
+    os.environ["SNAPSHOT_PATH"] = str(tmp_path_factory.mktemp("snapshot") / "db")
+
+
+@pytest.fixture(scope="session")
+def standin():
+    """
+    stand-ins of KoBo and Google Sheets, and the environment of the app
+    """
+    store = standins.Store([], synthetic.make_rotations())
+    server, url = standins.start(store)
+    os.environ.update(
+        {
+            "KOBO_URL": url,
+            "TOKEN": "test",
+            "ASSET": "test",
+            "GOOGLESHEETID": "test",
+            "GOOGLESERVICEACCUNT": json.dumps(standins.service_account(url)),
+            "SHEETS_URL": url + "/",
+            "KOBO_HOOK_SECRET": "secret",
+            "REFRESH_INTERVAL": "100000",
+        }
+    )
+    yield store
+    server.shutdown()
+
+
+@pytest.fixture
+def kobo_store(standin, tmp_path, monkeypatch):
+    """
+    the KoBo stand-in serving synthetic submissions, an empty local store
+    and an empty snapshot
+    """
+    import kobo
+
+    monkeypatch.setenv("SNAPSHOT_PATH", str(tmp_path / "snapshot.sqlite3"))
+    standin.submissions = {
+        x["_id"]: x for x in synthetic.make_submissions(SUBMISSIONS, days=60)
+    }
+    standin.rotations = synthetic.make_rotations(days=90)
+    standin.rejected = set()
+    standin.delay = 0
+    standin.failing_after = None
+    with kobo._store_lock:
+        kobo._submissions.clear()
+        kobo._revisions.clear()
+        kobo._high_water_mark = 0
+        kobo._held = True
+        # a new version, unknown to every cache
+        kobo._new_version(None)
+    return standin
+
+
+@pytest.fixture
+def app(kobo_store, monkeypatch):
+    """
+    the app, with data synced from the KoBo stand-in
+    """
+    import app
+    import kobo
+    import rotations
+
+    monkeypatch.setattr(rotations, "_rotations", None)
+    monkeypatch.setattr(app, "_data_cache", {})
+    # data is refreshed by the tests, not in the background while the next
+    # test replaces the local store
+    monkeypatch.setattr(app, "request_refresh", lambda: None)
+    kobo.sync_submissions()
+    app.refresh_data(sync=False)
+    return app
@@ -0,0 +1,140 @@
+# capture the outputs of the app before the summary, patient page and
+# export were rewritten, for the golden tests; run from the repo with a
+# checkout of the baseline commit:
+#
+#     git worktree add /tmp/baseline 90b2317
+#     python tests/golden/capture.py /tmp/baseline
+import json
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timezone
+
+import openpyxl
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+from benchmarks import synthetic  # noqa: E402
+from normalize import USED_COLUMNS  # noqa: E402
+
+# fixed end of the synthetic submissions, so that captures can be repeated
+END = datetime(2024, 6, 1, tzinfo=timezone.utc)
+
+# (number of submissions, share without bracelet number, columns dropped)
+CASES = [
+    (1, 0, []),
+    (5, 0, []),
+    (30, 0, []),
+    (30, 0.1, []),
+    (60, 0.3, []),
+    (60, 0, ["history", "info"]),
+    (120, 0.05, []),
+    (120, 0.2, ["vital_signs"]),
+    (200, 0, []),
+    (200, 0.1, []),
+]
+
+# patient pages captured in each case
+PATIENTS = 25
+
+
+def make_case(n, no_bracelet, dropped, seed):
+    """
+    submissions like KoBo's, with some patients without bracelet number,
+    missing values and columns
+    """
+    rnd = random.Random(seed)
+    submissions = synthetic.make_submissions(n, days=20, seed=seed, end=END)
+    for submission in submissions:
+        if rnd.random() < no_bracelet:
+            del submission["bracelet_number"]
+        for field in ["age", "gender", "referral_urgency", "treatment"]:
+            if field in submission.keys() and rnd.random() < 0.1:
+                del submission[field]
+        if rnd.random() < 0.2:
+            submission["history"] = rnd.choice(["cough", "none known"])
+        if rnd.random() < 0.2:
+            submission["vital_signs"] = rnd.choice(["normal", "fever 38.5"])
+        if rnd.random() < 0.2:
+            submission["info"] = "seen by the doctor"
+        for field in dropped:
+            submission.pop(field, None)
+    # only the fields the app reads
+    return [{k: v for k, v in x.items() if k in USED_COLUMNS} for x in submissions]
+
+
+def excel_cells(path):
+    """
+    values and column widths of the first sheet of an Excel file
+    """
+    sheet = openpyxl.load_workbook(path).worksheets[0]
+    rows = [
+        [x.isoformat() if isinstance(x, datetime) else x for x in row]
+        for row in sheet.iter_rows(values_only=True)
+    ]
+    widths = [
+        sheet.column_dimensions[openpyxl.utils.get_column_letter(ix + 1)].width
+        for ix in range(sheet.max_column)
+    ]
+    return {"rows": rows, "widths": widths}
+
+
+def capture(app, submissions):
+    """
+    summary, patient pages and export of the baseline app
+    """
+    df_form = pd.DataFrame(submissions)
+    result = {"submissions": submissions}
+    try:
+        summary = app.process_summary(df_form.copy())
+    except KeyError:
+        # raised by the baseline for some patients without bracelet number
+        summary = None
+    if summary is not None:
+        result["summary"] = {
+            "consultations": int(summary["consultations"]),
+            "patients": int(summary["patients"]),
+            "morbidities": [
+                [case, {k: v for k, v in counts.items() if k != "other"}]
+                for case, counts in summary["morbidities"].items()
+            ],
+            "referrals": list(summary["referrals"].items()),
+        }
+    result["patients"] = {}
+    bracelets = df_form.get("bracelet_number", pd.Series(dtype=object))
+    for bracelet in list(bracelets.dropna().unique())[:PATIENTS]:
+        page = app.process_data(df_form.copy(), bracelet)
+        for consultation in page["consultations"]:
+            consultation["Date"] = consultation["Date"].isoformat()
+        result["patients"][bracelet] = {
+            k: page[k] for k in ["info", "consultations", "referral"]
+        }
+    app.get_data = lambda: (df_form.copy(), 1)
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            result["export"] = excel_cells(app.download_data())
+        except KeyError:
+            # raised by the baseline without secondary or tertiary diagnoses
+            pass
+    return result
+
+
+def main():
+    sys.path.insert(0, sys.argv[1])
+    import app
+
+    app.render_template = lambda template, **context: context
+    app.send_file = lambda path, **kwargs: os.path.abspath(path)
+    cases = []
+    for seed, (n, no_bracelet, dropped) in enumerate(CASES):
+        submissions = make_case(n, no_bracelet, dropped, seed)
+        cases.append(capture(app, submissions))
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+    with open(path, "w") as file:
+        json.dump(cases, file, default=str)
+
+
+if __name__ == "__main__":
+    main()
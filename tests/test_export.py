@@ -0,0 +1,97 @@
+import json
+import os
+from datetime import datetime
+
+import openpyxl
+import pandas as pd
+import pytest
+
+import export
+import rotations
+from normalize import normalize_submissions
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+
+with open(os.path.join(GOLDEN, "baseline.json")) as file:
+    CASES = json.load(file)
+
+
+def excel_cells(buffer):
+    """
+    values and column widths of the first sheet of an Excel file
+    """
+    sheet = openpyxl.load_workbook(buffer).worksheets[0]
+    rows = [
+        [x.isoformat() if isinstance(x, datetime) else x for x in row]
+        for row in sheet.iter_rows(values_only=True)
+    ]
+    widths = [
+        sheet.column_dimensions[openpyxl.utils.get_column_letter(ix + 1)].width
+        for ix in range(sheet.max_column)
+    ]
+    return {"rows": rows, "widths": widths}
+
+
+@pytest.mark.parametrize(
+    "case",
+    [x for x in CASES if "export" in x],
+    ids=lambda x: str(len(x["submissions"])),
+)
+def test_excel_matches_baseline(case):
+    df_form = normalize_submissions(pd.DataFrame(case["submissions"]))
+    buffer = export.write_excel(export.referral_data(df_form))
+    assert excel_cells(buffer) == case["export"]
+
+
+def shifted(submissions, days, offset):
+    """
+    submissions started some days later, with other ids
+    """
+    return [
+        {
+            **x,
+            "_id": x["_id"] + offset,
+            "start": (pd.Timestamp(x["start"]) + pd.Timedelta(days=days)).isoformat(),
+        }
+        for x in submissions
+    ]
+
+
+def test_past_rotations_match_baseline():
+    # two rotations of the submissions of all time, whose exports are the
+    # baseline exports of each rotation alone (with the same columns)
+    first, second = [
+        x
+        for x in CASES
+        if "export" in x and x["export"]["rows"][0] == export.EXPORT_COLUMNS
+    ][:2]
+    df_all = normalize_submissions(
+        pd.DataFrame(first["submissions"] + shifted(second["submissions"], 40, 10000))
+    )
+    table = rotations.parse_rotations(
+        [
+            ["Rotation No", "Start date", "End date"],
+            ["1", "01/05/2024", "10/06/2024"],
+            ["2", "15/06/2024", "31/07/2024"],
+        ]
+    )
+    df_all["rotation_no"] = rotations.assign_rotations(df_all["start"], table)
+
+    def exported(**filters):
+        df_form = export.filter_data(df_all, **filters)
+        return excel_cells(export.write_excel(export.referral_data(df_form)))
+
+    assert exported(rotation=1) == first["export"]
+    assert exported(rotation=2) == second["export"]
+    dates = {
+        "start_date": export.parse_date("2024-06-11"),
+        "end_date": export.parse_date("2024-07-31"),
+    }
+    assert exported(**dates) == second["export"]
+    assert exported(rotation=3)["rows"] == [export.EXPORT_COLUMNS]
+
+
+def test_invalid_date():
+    assert export.parse_date(None) is None
+    with pytest.raises(ValueError):
+        export.parse_date("not a date")
@@ -0,0 +1,131 @@
+import random
+
+import pandas as pd
+import pytest
+
+import cube
+import kobo
+import rotations
+from normalize import normalize_submissions
+from summary import aggregate_summary
+from test_summary import morbidities
+
+
+def post_hook(app, submission, secret="secret"):
+    headers = {} if secret is None else {"X-Kobo-Hook-Secret": secret}
+    return app.app.test_client().post("/kobo-hook", json=submission, headers=headers)
+
+
+@pytest.mark.parametrize("secret", [None, "wrong", "sécret"])
+def test_hook_rejects_invalid_secret(app, kobo_store, secret):
+    submission = {**kobo_store.submissions[1], "_xform_id_string": "test"}
+    response = post_hook(app, submission, secret)
+    assert response.status_code == 403
+
+
+def test_hook_rejects_submission_without_id(app, kobo_store):
+    submission = {**kobo_store.submissions[1], "_xform_id_string": "test"}
+    del submission["_id"]
+    assert post_hook(app, submission).status_code == 400
+    assert post_hook(app, None).status_code == 400
+
+
+def test_hook_adds_submission(app, kobo_store):
+    submission = {**kobo_store.submissions[1], "_id": 1000, "_xform_id_string": "test"}
+    response = post_hook(app, submission)
+    assert response.status_code == 200
+    assert response.get_json() == {"_id": 1000}
+    assert kobo.get_submissions([1000])[0]["bracelet_number"] == (
+        submission["bracelet_number"]
+    )
+
+
+def full_data():
+    """
+    normalized submissions of the local store, rebuilt from scratch
+    """
+    df_all = normalize_submissions(pd.DataFrame(kobo.get_submissions()))
+    df_all["rotation_no"] = rotations.assign_rotations(
+        df_all["start"], rotations.get_last_rotations()
+    )
+    return df_all
+
+
+def change_submissions(rnd, kobo_store):
+    """
+    new, edited and deleted submissions in the KoBo stand-in; edits may
+    move submissions to other patients and rotations
+    """
+    submissions = kobo_store.submissions
+    ids = sorted(submissions.keys())
+    for _ in range(rnd.randint(0, 10)):
+        submission = dict(submissions[rnd.choice(ids)])
+        submission["_id"] = max(submissions.keys()) + rnd.randint(1, 3)
+        submissions[submission["_id"]] = submission
+    for submission_id in rnd.sample(ids, rnd.randint(0, 10)):
+        submission = dict(submissions[submission_id])
+        other = submissions[rnd.choice(ids)]
+        for field in ["bracelet_number", "primary_case", "referral", "start"]:
+            if rnd.random() < 0.5 and field in other.keys():
+                submission[field] = other[field]
+        submission["meta/instanceID"] += "-edited"
+        submissions[submission_id] = submission
+    for submission_id in rnd.sample(ids, rnd.randint(0, 5)):
+        del submissions[submission_id]
+
+
+def change_rotations(rnd, kobo_store):
+    """
+    move the end of a rotation and the start of the next one, or drop the
+    last rotation
+    """
+    values = kobo_store.rotations
+    if rnd.random() < 0.2 and len(values) > 3:
+        kobo_store.rotations = values[:-1]
+        return
+    ix = rnd.randrange(1, len(values) - 1)
+    end = pd.Timestamp(values[ix][2][6:] + values[ix][2][2:6] + values[ix][2][:2])
+    end += pd.Timedelta(days=rnd.randint(-5, 5))
+    values = [list(x) for x in values]
+    values[ix][2] = end.strftime("%d/%m/%Y")
+    values[ix + 1][1] = (end + pd.Timedelta(days=1)).strftime("%d/%m/%Y")
+    kobo_store.rotations = values
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_incremental_data_matches_full_rebuild(app, kobo_store, monkeypatch, seed):
+    monkeypatch.setenv("ROTATIONS_TTL", "0")
+    rnd = random.Random(seed)
+    for _ in range(12):
+        action = rnd.random()
+        if action < 0.5:
+            change_submissions(rnd, kobo_store)
+            app.refresh_data()
+        elif action < 0.75:
+            # a new or edited submission from the webhook
+            submission = dict(
+                kobo_store.submissions[rnd.choice(list(kobo_store.submissions))]
+            )
+            submission["_id"] = rnd.choice(
+                [submission["_id"], submission["_id"] + 5000]
+            )
+            submission["primary_case"] = rnd.choice(["fever", "burn", "scabies"])
+            submission["_xform_id_string"] = "test"
+            assert post_hook(app, submission).status_code == 200
+        else:
+            change_rotations(rnd, kobo_store)
+            app.refresh_data()
+
+        expected = full_data()
+        df_all = app._all_data[2]
+        pd.testing.assert_frame_equal(df_all.reset_index(drop=True), expected)
+
+        numbers = rotations.get_last_rotations()["Rotation No"]
+        assert cube.rotation_nos() == sorted((int(x) for x in numbers), reverse=True)
+        for number in numbers:
+            df = expected[expected["rotation_no"] == number].reset_index(drop=True)
+            consultations, patients, summary, referrals = aggregate_summary(df)
+            result = cube.rotation_summary(int(number))
+            assert result[:2] == (consultations, patients)
+            assert morbidities(result[2]) == morbidities(summary)
+            assert list(result[3].items()) == list(referrals.items())
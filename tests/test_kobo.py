@@ -0,0 +1,114 @@
+import threading
+import time
+
+import pytest
+
+import kobo
+import snapshot
+
+
+def remote(kobo_store):
+    """
+    submissions of the KoBo stand-in, as the local store holds them
+    """
+    return {
+        k: {f: v for f, v in x.items() if f not in kobo.UNUSED_FIELDS}
+        for k, x in kobo_store.submissions.items()
+    }
+
+
+def local():
+    """
+    submissions of the local store and of the snapshot, by _id
+    """
+    stored = {x["_id"]: x for x in kobo.get_submissions()}
+    saved = {x["_id"]: x for x in snapshot.load_submissions()[0]}
+    return stored, saved
+
+
+def test_first_sync_stores_all_submissions(kobo_store):
+    version = kobo.get_version()
+    assert kobo.sync_submissions()
+    stored, saved = local()
+    assert stored == saved == remote(kobo_store)
+    assert kobo.get_changes(version) == set(stored)
+    assert kobo.get_synced_at() is not None
+    assert not kobo.sync_submissions()
+
+
+def test_sync_stores_new_edited_and_deleted_submissions(kobo_store):
+    kobo.sync_submissions()
+    version = kobo.get_version()
+    submissions = kobo_store.submissions
+    new = dict(submissions[10], _id=1000)
+    edited = dict(submissions[20], referral="yes")
+    edited["meta/instanceID"] += "-edited"
+    submissions.update({1000: new, 20: edited})
+    del submissions[30]
+
+    assert kobo.sync_submissions()
+    stored, saved = local()
+    assert stored == saved == remote(kobo_store)
+    assert kobo.get_changes(version) == {1000, 20, 30}
+
+
+def test_sync_fetches_submissions_missed_below_the_high_water_mark(kobo_store):
+    kobo.sync_submissions()
+    submissions = kobo_store.submissions
+    submissions[1000] = dict(submissions[10], _id=1000)
+    submissions[1001] = dict(submissions[11], _id=1001)
+    # the newest one arrives first, from the webhook
+    kobo.add_submission(remote(kobo_store)[1001])
+
+    kobo.sync_submissions()
+    stored, saved = local()
+    assert stored == saved == remote(kobo_store)
+
+
+def test_failed_sync_keeps_the_pages_stored(kobo_store, monkeypatch):
+    monkeypatch.setenv("KOBO_PAGE_SIZE", "50")
+    kobo_store.failing_after = 3
+    version, synced_at = kobo.get_version(), kobo.get_synced_at()
+    with pytest.raises(ValueError):
+        kobo.sync_submissions()
+    stored, saved = local()
+    assert len(stored) == 150
+    assert stored == saved
+    # the stored pages are new versions, which later changes build on
+    assert kobo.get_changes(version) == set(stored)
+    assert kobo.get_synced_at() == synced_at
+    version = kobo.get_version()
+
+    kobo_store.failing_after = None
+    assert kobo.sync_submissions()
+    stored, saved = local()
+    assert stored == saved == remote(kobo_store)
+    assert kobo.get_changes(version) == set(stored) - set(range(1, 151))
+
+
+def test_sync_does_not_lock_the_store_while_downloading(kobo_store):
+    kobo.sync_submissions()
+    kobo_store.delay = 1
+    sync = threading.Thread(target=kobo.sync_submissions)
+    sync.start()
+    time.sleep(0.2)
+    started_at = time.time()
+    kobo.add_submission(dict(remote(kobo_store)[10], _id=1000))
+    kobo.get_changes(0)
+    kobo.get_submissions([1000])
+    assert time.time() - started_at < 0.5
+    # a second sync does not wait for the one running
+    assert not kobo.sync_submissions()
+    sync.join()
+    assert 1000 in local()[0].keys()
+
+
+def test_update_writes_through_only_what_kobo_updated(kobo_store):
+    kobo.sync_submissions()
+    kobo_store.rejected = {4}
+    data = {"referral": "yes", "referral_urgency": "medevac"}
+    assert kobo.update_submissions([3, 4, 5], data) == [3, 5]
+    stored, saved = local()
+    assert stored == saved == remote(kobo_store)
+    assert stored[4].get("referral_urgency") != "medevac"
+    assert not kobo.sync_submissions()
@@ -0,0 +1,97 @@
+import gzip
+import time
+from collections import OrderedDict
+
+import kobo
+import pages
+
+
+def get(client, path, **headers):
+    return client.get(path, headers=headers)
+
+
+def test_page_is_revalidated_with_its_etag(app):
+    client = app.app.test_client()
+    response = get(client, "/summary")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    assert etag.startswith('W/"')
+    assert response.cache_control.private and response.cache_control.no_cache
+    assert "Accept-Encoding" in response.vary
+
+    response = get(client, "/summary", **{"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.get_data() == b""
+    assert response.headers["ETag"] == etag
+    assert "Content-Encoding" not in response.headers
+
+    # only GET and HEAD are answered from the client's copy
+    response = client.post("/summary", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.get_data() != b""
+
+
+def test_etag_changes_with_the_data_and_its_age(app, kobo_store, monkeypatch):
+    client = app.app.test_client()
+    etag = get(client, "/summary").headers["ETag"]
+    assert get(client, "/summary").headers["ETag"] == etag
+
+    # older data is shown with another age
+    monkeypatch.setattr(kobo, "_synced_at", time.time() - 7200)
+    aged = get(client, "/summary").headers["ETag"]
+    assert aged != etag
+
+    # new data
+    submission = {**kobo_store.submissions[1], "_id": 1000, "_xform_id_string": "test"}
+    client.post("/kobo-hook", json=submission, headers={"X-Kobo-Hook-Secret": "secret"})
+    response = get(client, "/summary", **{"If-None-Match": aged})
+    assert response.status_code == 200
+    assert response.headers["ETag"] not in (etag, aged)
+
+
+def test_pages_are_gzipped_once(app):
+    client = app.app.test_client()
+    plain = get(client, "/summary")
+    assert "Content-Encoding" not in plain.headers
+    for path in ["/summary", "/metrics"]:
+        response = get(client, path, **{"Accept-Encoding": "gzip"})
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert list(response.vary).count("Accept-Encoding") == 1
+        body = gzip.decompress(response.get_data())
+        if path == "/summary":
+            assert body == plain.get_data()
+
+    # small responses are sent as they are
+    response = get(client, "/search?q=zzzz", **{"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert len(response.get_data()) < pages.GZIP_MIN_BYTES
+    assert "Content-Encoding" not in response.headers
+
+
+def test_page_cache_keeps_recent_pages_of_the_latest_data(monkeypatch):
+    monkeypatch.setattr(pages, "_pages", OrderedDict())
+    monkeypatch.setattr(pages, "PAGE_CACHE_SIZE", 2)
+    rendered = []
+
+    def page(tag, view):
+        def render():
+            rendered.append((tag, view))
+            return f"{tag} {view}"
+
+        return pages.get_page(tag, view, render)
+
+    assert page("a", 1)[0] == b"a 1"
+    assert gzip.decompress(page("a", 1)[1]) == b"a 1"
+    page("a", 2)
+    page("a", 1)
+    page("a", 3)
+    # least recently used page dropped
+    page("a", 1)
+    page("a", 2)
+    assert rendered == [("a", 1), ("a", 2), ("a", 3), ("a", 2)]
+
+    # pages of older data are dropped
+    page("b", 1)
+    assert list(pages._pages.keys()) == [("b", 1)]
+    assert pages.make_etag("a", 1) != pages.make_etag("b", 1)
+    assert pages.make_etag("a", 1) == pages.make_etag("a", 1)
@@ -0,0 +1,44 @@
+import re
+
+from patients import get_patient
+
+
+def results(html):
+    """
+    bracelet number -> result of the table of updated referrals
+    """
+    rows = re.findall(
+        r"<tr>\s*<td[^>]*>([^<]*)</td>\s*<td[^>]*>[^<]*</td>\s*<td[^>]*>([^<]*)</td>",
+        html,
+    )
+    return dict(rows)
+
+
+def test_bulk_update_reports_each_patient(app, kobo_store):
+    df_form, _ = app.get_data()
+    bracelets = [str(x) for x in df_form["bracelet_number"].dropna().unique()[:6]]
+    latest = {x: int(get_patient(df_form, x)["_id"].iloc[-1]) for x in bracelets}
+    kobo_store.rejected = {latest[bracelets[1]]}
+
+    response = app.app.test_client().post(
+        "/updatesubmissions",
+        data={
+            "bracelets": ", ".join(bracelets[:4]) + "\nunknown",
+            "bracelets_referral": "Referral is needed, urgent",
+            "bracelet": [bracelets[4], bracelets[5]],
+            "referral": ["Referral is not needed", "not a status"],
+        },
+    )
+    assert response.status_code == 200
+    assert results(response.get_data(as_text=True)) == {
+        bracelets[0]: "updated",
+        bracelets[1]: "rejected by KoBo",
+        bracelets[2]: "updated",
+        bracelets[3]: "updated",
+        "unknown": "patient not found",
+        bracelets[4]: "updated",
+        bracelets[5]: "unknown referral status",
+    }
+    for bracelet in [bracelets[0], bracelets[2], bracelets[3]]:
+        submission = kobo_store.submissions[latest[bracelet]]
+        assert submission["referral_urgency"] == "urgent"
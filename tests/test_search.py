@@ -0,0 +1,98 @@
+import re
+
+import pandas as pd
+import pytest
+
+from normalize import normalize_submissions
+from search import search_patients
+
+SUBMISSIONS = [
+    (1, "12", "Amadou Diallo", "scabies", "2024-05-01"),
+    (2, "123", "Amadou Sow", "burn", "2024-05-02"),
+    (3, "124", "Mariam Sow", "scabies", "2024-05-03"),
+    (4, "13", "Fatima", "burn", "2024-05-04"),
+    (5, "2", "Yusuf", "scabies", "2024-05-05"),
+    (6, "123", "Amadou Sow Ba", "dental", "2024-05-06"),
+]
+
+
+@pytest.fixture
+def df_form():
+    df_form = normalize_submissions(
+        pd.DataFrame(
+            [
+                {
+                    "_id": submission_id,
+                    "bracelet_number": bracelet,
+                    "name": name,
+                    "primary_case": case,
+                    "start": start,
+                }
+                for submission_id, bracelet, name, case, start in SUBMISSIONS
+            ]
+        )
+    )
+    # the search index is kept by data version
+    df_form.attrs["version"] = ("test", id(df_form))
+    return df_form
+
+
+def bracelets(results):
+    return [x["bracelet_number"] for x in results]
+
+
+def test_bracelet_prefix(df_form):
+    assert bracelets(search_patients(df_form, "12")) == ["12", "123", "124"]
+    assert bracelets(search_patients(df_form, "13")) == ["13"]
+    assert search_patients(df_form, "9") == []
+    assert search_patients(df_form, " ") == []
+
+
+def test_words_of_names_and_diagnoses(df_form):
+    assert bracelets(search_patients(df_form, "amadou")) == ["12", "123"]
+    # every word of the query must match, as a prefix
+    assert bracelets(search_patients(df_form, "ama so")) == ["123"]
+    assert bracelets(search_patients(df_form, "Sow")) == ["123", "124"]
+    assert bracelets(search_patients(df_form, "scabies")) == ["12", "124", "2"]
+    # names of older consultations and diagnoses are found too
+    assert bracelets(search_patients(df_form, "burn")) == ["123", "13"]
+
+
+def test_patients_with_latest_name_and_consultation(df_form):
+    assert search_patients(df_form, "123") == [
+        {"bracelet_number": "123", "name": "Amadou Sow Ba", "last_seen": "2024-05-06"}
+    ]
+
+
+def test_limit(df_form):
+    assert bracelets(search_patients(df_form, "1", limit=2)) == ["12", "123"]
+    assert len(search_patients(df_form, "a", limit=1)) == 1
+
+
+def suggestions(html):
+    return re.findall(r'name="bracelet" value="([^"]*)"', html)
+
+
+def test_unknown_bracelet_suggests_others(app):
+    df_form, _ = app.get_data()
+    bracelet = str(df_form["bracelet_number"].dropna().iloc[0])
+    known = set(df_form["bracelet_number"].dropna().astype(str))
+    client = app.app.test_client()
+
+    # a mistyped last digit
+    typo = next(bracelet + x for x in "0123456789" if bracelet + x not in known)
+    html = client.get(f"/dataupdate?bracelet={typo}").get_data(as_text=True)
+    assert bracelet in suggestions(html)
+
+    # no bracelet number
+    assert client.get("/dataupdate").status_code == 200
+    assert client.post("/dataupdate").status_code == 200
+
+
+def test_search_route_limit(app):
+    df_form, _ = app.get_data()
+    query = str(df_form["bracelet_number"].dropna().iloc[0])[0]
+    client = app.app.test_client()
+    for limit, expected in [(-1, 1), (0, 1), (1000, 100)]:
+        results = client.get(f"/search?q={query}&limit={limit}").get_json()
+        assert 0 < len(results) <= expected
@@ -0,0 +1,70 @@
+import json
+import os
+import random
+
+import pandas as pd
+import pytest
+
+from normalize import normalize_submissions
+from summary import LABELS, SummaryState, aggregate_summary
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+
+with open(os.path.join(GOLDEN, "baseline.json")) as file:
+    CASES = json.load(file)
+
+
+def morbidities(summary):
+    """
+    counts and bracelet numbers of each morbidity, in order
+    """
+    return [
+        [case, {k: v for k, v in counts.items() if k in LABELS + ["bracelet"]}]
+        for case, counts in summary.items()
+    ]
+
+
+@pytest.mark.parametrize(
+    "case",
+    [x for x in CASES if "summary" in x],
+    ids=lambda x: str(len(x["submissions"])),
+)
+def test_summary_matches_baseline(case):
+    df_form = normalize_submissions(pd.DataFrame(case["submissions"]))
+    consultations, patients, summary, referrals = aggregate_summary(df_form)
+    golden = case["summary"]
+    assert consultations == golden["consultations"]
+    assert patients == golden["patients"]
+    assert morbidities(summary) == golden["morbidities"]
+    assert list(referrals.items()) == [tuple(x) for x in golden["referrals"]]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_incremental_summary_matches_aggregate(seed):
+    rnd = random.Random(seed)
+    submissions = [x for case in CASES for x in case["submissions"]]
+    df_pool = normalize_submissions(pd.DataFrame(rnd.sample(submissions, 300)))
+    state = SummaryState()
+    # _id -> row of df_pool of the submissions in state
+    current = {}
+    for _ in range(40):
+        if rnd.random() < 0.6 or not current:
+            # new submissions, and edits that may move them to other patients
+            ids = {
+                rnd.choice([rnd.randrange(1000), *current.keys()]): rnd.randrange(300)
+                for _ in range(rnd.randint(1, 20))
+            }
+            state.upsert(df_pool.iloc[list(ids.values())].assign(_id=list(ids)))
+            current.update(ids)
+        else:
+            ids = rnd.sample(sorted(current.keys()), min(len(current), 10))
+            state.remove(ids)
+            for x in ids:
+                del current[x]
+        ids = sorted(current.keys())
+        df_form = df_pool.iloc[[current[x] for x in ids]].assign(_id=ids)
+        expected = aggregate_summary(df_form.reset_index(drop=True))
+        consultations, patients, summary, referrals = state.summary()
+        assert (consultations, patients) == expected[:2]
+        assert morbidities(summary) == morbidities(expected[2])
+        assert list(referrals.items()) == list(expected[3].items())
@@ -0,0 +1,47 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+from normalize import normalize_submissions
+from patients import get_patient, get_patients
+from timeline import build_timelines
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+
+with open(os.path.join(GOLDEN, "baseline.json")) as file:
+    CASES = json.load(file)
+
+
+def plain(timeline):
+    """
+    timeline with dates as in the golden files
+    """
+    consultations = [
+        {**x, "Date": x["Date"].isoformat()} for x in timeline["consultations"]
+    ]
+    return {**timeline, "consultations": consultations}
+
+
+@pytest.fixture(params=CASES, ids=lambda x: str(len(x["submissions"])))
+def case(request):
+    df_form = normalize_submissions(pd.DataFrame(request.param["submissions"]))
+    # the patient index is kept by data version
+    df_form.attrs["version"] = ("test", id(request.param))
+    return df_form, request.param["patients"]
+
+
+def test_patient_page_matches_baseline(case):
+    df_form, golden = case
+    for bracelet, expected in golden.items():
+        timelines = build_timelines(get_patient(df_form, bracelet))
+        assert list(timelines.keys()) == [bracelet]
+        assert plain(timelines[bracelet]) == expected
+
+
+def test_all_timelines_match_baseline(case):
+    df_form, golden = case
+    timelines = build_timelines(get_patients(df_form))
+    for bracelet, expected in golden.items():
+        assert plain(timelines[bracelet]) == expected
@@ -0,0 +1,163 @@
+import numpy as np
+import pandas as pd
+
+from labels import case_labels, map_age, translate
+from summary import LEVELS
+
+# patient information shown with the consultations, latest value first
+INFO_FIELDS = ["name", "gender", "age"]
+
+# column -> (heading, text when missing) of the consultation details;
+# missing other information is left out
+DETAIL_COLUMNS = {
+    "history": ("History", "none"),
+    "vital_signs": ("Vital signs", "none"),
+    "treatment": ("Treatment", "nothing"),
+    "info": ("Other information", None),
+}
+
+
+def _groups(df):
+    """
+    position of the first row of each patient in df, whose rows are grouped
+    by patient
+    """
+    bracelets = df["bracelet_number"].to_numpy(dtype=object)
+    return np.flatnonzero(np.r_[True, bracelets[1:] != bracelets[:-1]])
+
+
+def _values(series, labels=None):
+    """
+    values of a column as an array, with NaN for missing values; codes are
+    replaced by their labels once per category
+    """
+    if labels is not None and isinstance(series.dtype, pd.CategoricalDtype):
+        categories = [labels.get(x, x) for x in series.cat.categories]
+        codes = series.cat.codes.to_numpy()
+        values = np.array(categories + [np.nan], dtype=object)[codes]
+        return values
+    if labels is not None:
+        series = translate(series, labels)
+    return series.to_numpy(dtype=object, na_value=np.nan)
+
+
+def diagnoses(df):
+    """
+    diagnoses of each consultation joined as text, with the description of
+    diagnoses coded as other
+    """
+    diagnosis = np.full(len(df), "", dtype=object)
+    for level in LEVELS:
+        if level + "_case" not in df.columns:
+            continue
+        case = _values(df[level + "_case"], case_labels())
+        if level + "_case_other" in df.columns:
+            other = case == "Other"
+            case[other] = _values(df[level + "_case_other"])[other]
+        given = ~pd.isna(case)
+        joined = diagnosis[given] + ", " + case[given]
+        diagnosis[given] = np.where(diagnosis[given] == "", case[given], joined)
+    return diagnosis
+
+
+def consultation_details(df):
+    """
+    date, diagnosis and details of each consultation as a dict
+    """
+    columns = {
+        "Date": pd.to_datetime(df["start"], utc=True).dt.date.to_numpy(),
+        "Diagnosis": diagnoses(df),
+    }
+    for column, (heading, missing) in DETAIL_COLUMNS.items():
+        if column in df.columns:
+            values = _values(df[column])
+            if missing is not None:
+                values[pd.isna(values)] = missing
+            columns[heading] = values
+        elif column == "treatment":
+            columns[heading] = np.full(len(df), missing, dtype=object)
+    keys = list(columns.keys())
+    return [
+        {
+            k: v
+            for k, v in zip(keys, row)
+            if not (k == "Other information" and pd.isna(v))
+        }
+        for row in zip(*columns.values())
+    ]
+
+
+def latest_info(df, starts):
+    """
+    name, gender and age of each patient: the last distinct value given, or
+    unknown
+    """
+    group = np.zeros(len(df), dtype=int)
+    group[starts[1:]] = 1
+    group = np.cumsum(group)
+    info = {}
+    for field in INFO_FIELDS:
+        if field not in df.columns:
+            continue
+        # first row of each value of each patient; the latest of these rows
+        # is the last distinct value of the patient
+        codes, uniques = pd.factorize(df[field])
+        rows = np.flatnonzero(codes >= 0)
+        keys = group[rows] * len(uniques) + codes[rows]
+        firsts = np.sort(rows[np.unique(keys, return_index=True)[1]])
+        latest = np.full(len(starts), "unknown", dtype=object)
+        if len(firsts) > 0:
+            lasts = firsts[np.r_[group[firsts][1:] != group[firsts][:-1], True]]
+            latest[group[lasts]] = np.asarray(uniques, dtype=object)[codes[lasts]]
+        if field == "age":
+            latest = [x if x == "unknown" else map_age(x) for x in latest]
+        info[field] = latest
+    return [{k: v[ix] for k, v in info.items()} for ix in range(len(starts))]
+
+
+def referral_status(df, ends):
+    """
+    referral status after the last consultation of each patient
+    """
+    missing = np.full(len(ends), np.nan, dtype=object)
+    referrals, urgencies = missing, missing
+    if "referral" in df.columns:
+        referrals = _values(df["referral"])[ends]
+    if "referral_urgency" in df.columns:
+        urgencies = _values(df["referral_urgency"])[ends]
+    status = []
+    for referral, level in zip(referrals, urgencies):
+        if referral == "yes" and pd.isna(level):
+            status.append({"Referral is needed": ""})
+        elif referral == "yes" and level.replace("_", " ") != "not needed":
+            status.append({"Referral is needed:": level.replace("_", " ")})
+        else:
+            status.append({"Referral is not needed": ""})
+    return status
+
+
+def build_timelines(df):
+    """
+    information, consultations and referral status of each patient in df,
+    whose rows are grouped by patient and sorted by start, built one column
+    at a time for all patients together
+    """
+    if df.empty:
+        return {}
+    starts = _groups(df)
+    ends = np.r_[starts[1:], len(df)]
+    consultations = consultation_details(df)
+    return {
+        bracelet: {
+            "info": info,
+            "consultations": consultations[start:end],
+            "referral": referral,
+        }
+        for bracelet, start, end, info, referral in zip(
+            df["bracelet_number"].iloc[starts],
+            starts,
+            ends,
+            latest_info(df, starts),
+            referral_status(df, ends - 1),
+        )
+    }